@@ -0,0 +1,151 @@
+"""
+Compares the PDF rendering engines (PVS_PDF_ENGINE).
+
+Each engine renders the pages of the given PDFs (the PDF fixtures by default)
+to image previews, in a process of its own so that its memory use can be
+measured. Per-page latency and the peak RSS of each engine (above that of the
+process once the engine is imported) are reported.
+
+Only preview/backends/raster.py is loaded, not the rest of the server.
+
+python benchmark.py [-s WIDTHxHEIGHT] [-p PAGES] [-e ENGINE] [FILE ...]
+"""
+import sys
+import glob
+import argparse
+import resource
+import statistics
+import importlib.util
+
+from time import time
+from os.path import basename, dirname
+from os.path import join as pathjoin
+from tempfile import NamedTemporaryFile
+from concurrent.futures import ProcessPoolExecutor
+
+FIXTURES = pathjoin(dirname(__file__), 'fixtures')
+RASTER = pathjoin(dirname(__file__), 'preview', 'backends', 'raster.py')
+ENGINES = ['ghostscript', 'mupdf']
+
+
+def load_raster():
+    "Loads the engines without importing the preview package (the server)."
+    spec = importlib.util.spec_from_file_location('raster', RASTER)
+    raster = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(raster)
+    return raster
+
+
+def current_rss():
+    "Returns the current RSS in bytes."
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def render(engine, paths, width, height, max_pages):
+    """
+    Renders up to max_pages pages of each path. Returns a list of (path,
+    page, duration, error) tuples, and the peak RSS in bytes above the
+    baseline taken once the engine is imported.
+    """
+    # Engines run in this process (raster.WORKERS is 0).
+    raster = load_raster()
+    if engine == 'mupdf':
+        import fitz  # noqa: F401
+    baseline = current_rss()
+
+    f, results = raster.ENGINES[engine], []
+    for path in paths:
+        for page in range(1, max_pages + 1):
+            with NamedTemporaryFile(suffix='.png') as t:
+                start = time()
+                try:
+                    count = f(path, page, width, height, t.name)
+                    if count is None:
+                        raise Exception('Could not determine page size')
+
+                except Exception as e:
+                    results.append((path, page, None, str(e)))
+                    break
+
+                if count < page:
+                    break
+
+                results.append((path, page, time() - start, None))
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return results, max(0, rss - baseline)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(engine, results, rss):
+    print('%s: peak RSS +%.1fMB' % (engine, rss / 1024 ** 2))
+
+    durations = []
+    for path in sorted(set(r[0] for r in results)):
+        rows = [r for r in results if r[0] == path]
+        times = [r[2] for r in rows if r[2] is not None]
+        errors = [r[3] for r in rows if r[3] is not None]
+        durations.extend(times)
+
+        if times:
+            print('  %-30s %3i pages, first %8.1fms, mean %8.1fms/page' % (
+                basename(path)[:30], len(times), times[0] * 1000,
+                statistics.mean(times) * 1000))
+        for error in errors:
+            print('  %-30s error: %s' % (basename(path)[:30], error))
+
+    if durations:
+        print('  %-30s %3i pages, p50 %8.1fms, p95 %8.1fms, max %8.1fms' % (
+            'total', len(durations), percentile(durations, 50) * 1000,
+            percentile(durations, 95) * 1000, max(durations) * 1000))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='python benchmark.py',
+        description='Compare the per-page latency and memory use of PDF '
+                    'rendering engines.')
+    parser.add_argument(
+        'paths', nargs='*', help='PDF files [default: fixtures/*.pdf]')
+    parser.add_argument(
+        '-s', '--size', default='320x240',
+        help='Preview size as WIDTHxHEIGHT [default: 320x240]')
+    parser.add_argument(
+        '-p', '--pages', type=int, default=10,
+        help='Maximum pages to render per file [default: 10]')
+    parser.add_argument(
+        '-e', '--engine', dest='engines', action='append', choices=ENGINES,
+        help='Engine to benchmark, can be given multiple times '
+             '[default: all]')
+    args = parser.parse_args(argv)
+
+    try:
+        width, height = map(int, args.size.lower().split('x'))
+
+    except ValueError:
+        parser.error('Size must be WIDTHxHEIGHT, ex: 320x240')
+
+    paths = args.paths or sorted(glob.glob(pathjoin(FIXTURES, '*.pdf')))
+    for engine in args.engines or ENGINES:
+        # A fresh process per engine, so the RSS is that engine's alone.
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                results, rss = executor.submit(
+                    render, engine, paths, width, height, args.pages).result()
+
+            except Exception as e:
+                print('%s: failed: %s' % (engine, e))
+                continue
+
+        report(engine, results, rss)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
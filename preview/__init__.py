@@ -1,4 +1,6 @@
 import os
+import struct
+import hashlib
 import logging
 import functools
 import pathlib
@@ -8,7 +10,8 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
 from io import StringIO
-from os.path import normpath, isfile, getsize, dirname
+from os.path import isfile, getsize, dirname
+from os import stat
 from os.path import join as pathjoin
 
 from tempfile import NamedTemporaryFile
@@ -30,19 +33,21 @@ from preview import icons
 from preview.utils import (
     run_in_executor, log_duration, get_extension, chroot
 )
-from preview.preview import generate, UnsupportedTypeError, Backend
-from preview.storage import BASE_PATH
+from preview.preview import (
+    generate, get_info, UnsupportedTypeError, Backend,
+)
+from preview.storage import BASE_PATH, make_key, resolve_path
 from preview.metrics import (
     metrics_handler, metrics_middleware, TRANSFER_LATENCY,
     TRANSFERS_IN_PROGRESS
 )
 from preview.config import (
     boolean, DEFAULT_FORMAT, DEFAULT_WIDTH, DEFAULT_HEIGHT, MAX_WIDTH,
-    MAX_HEIGHT, LOGLEVEL, HTTP_LOGLEVEL, FILE_ROOT, CACHE_CONTROL,
-    X_ACCEL_REDIR, MAX_FILE_SIZE, MAX_PAGES, PLUGINS,
+    MAX_HEIGHT, LOGLEVEL, HTTP_LOGLEVEL, CACHE_CONTROL,
+    X_ACCEL_REDIR, MAX_FILE_SIZE, MAX_PAGES, MAX_SPRITE_PAGES, PLUGINS,
 )
-from preview.models import PreviewModel
-from preview.errors import InvalidPageError
+from preview.models import PreviewModel, BufferModel
+from preview.errors import InvalidPageError, CircuitOpenError
 
 
 # Limits
@@ -51,6 +56,8 @@ BUFFER_SIZE = 8 * MEGABYTE
 MAX_UPLOAD = 800 * MEGABYTE
 ROOT = dirname(__file__)
 SENTRY_DSN = os.environ.get('SENTRY_DSN', None)
+# Offset of each page within a sprite.
+SPRITE_MAP_HEADER = 'X-Sprite-Map'
 
 # For source code formatting.
 # (variable_declaration, comment, line_ending)
@@ -79,6 +86,79 @@ def set_cache_control(obj):
     obj.headers['Cache-Control'] = 'max-age=%i, public' % max_age
 
 
+def write_chunk(f, h, data):
+    # Hash the data while writing it.
+    h.update(data)
+    f.write(data)
+
+
+def get_validators(obj):
+    """
+    Returns a tuple of (etag, last_modified) for the preview of obj. Either
+    may be None if the source can not be identified.
+    """
+    params = (obj.format, obj.width, obj.height, obj.args.get('pages'))
+
+    if obj.digest is not None:
+        # The preview is determined by the contents of the file.
+        key = make_key('sha256:%s.%s' % (obj.digest, obj.extension), *params)
+        return '"%s"' % key, None
+
+    if not obj.src.is_shared:
+        # Temporary files have no stable identity.
+        return None, None
+
+    mtime = stat(obj.src.path).st_mtime
+    return '"%s"' % make_key(obj.origin, mtime, *params), mtime
+
+
+def is_not_modified(request, etag, last_modified):
+    "Evaluates conditional request headers."
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        if etag is None:
+            return False
+
+        # Weak comparison, as per RFC 7232.
+        tags = [t.strip() for t in if_none_match.split(',')]
+        tags = [t[2:] if t.startswith('W/') else t for t in tags]
+        return '*' in tags or etag in tags
+
+    # If-Modified-Since is ignored when If-None-Match is present.
+    if_modified_since = request.if_modified_since
+    if if_modified_since is not None and last_modified is not None:
+        return int(last_modified) <= if_modified_since.timestamp()
+
+    return False
+
+
+def set_validators(obj, etag, last_modified):
+    if etag is not None:
+        obj.headers['ETag'] = etag
+    if last_modified is not None:
+        obj.last_modified = last_modified
+
+
+def get_sprite_map(obj):
+    """
+    Returns the offset (in pixels from the top) of each page in a sprite, as
+    comma separated page=offset pairs.
+    """
+    if isinstance(obj.dst, BufferModel):
+        header = obj.dst.data[:24]
+
+    else:
+        with open(obj.dst.path, 'rb') as f:
+            header = f.read(24)
+
+    # The PNG height follows the signature, IHDR chunk header and width.
+    height, = struct.unpack('>I', header[20:24])
+    first = obj.args.get('pages')[0] or 1
+    return ','.join(
+        '%i=%i' % (first + i, i * obj.height)
+        for i in range(height // obj.height))
+
+
 @log_duration
 async def upload(upload):
     extension = get_extension(upload.filename)
@@ -87,15 +167,15 @@ async def upload(upload):
 
     with tl.time(), tip.track_inprogress():
         with NamedTemporaryFile(delete=False, suffix='.%s' % extension) as t:
-            size = 0
+            size, h = 0, hashlib.sha256()
             while True:
                 data = await run_in_executor(upload.file.read)(BUFFER_SIZE)
                 if not data:
                     break
                 size += len(data)
                 check_size(size)
-                await run_in_executor(t.write)(data)
-        return t.name
+                await run_in_executor(write_chunk)(t, h, data)
+        return t.name, h.hexdigest()
 
 
 @log_duration
@@ -112,7 +192,7 @@ async def download(url):
                         reason='Could not download: %s, %s' % (
                             url, resp.reason))
 
-                size = 0
+                size, h = 0, hashlib.sha256()
                 with NamedTemporaryFile(
                         delete=False, suffix='.%s' % extension) as t:
                     while True:
@@ -121,8 +201,8 @@ async def download(url):
                             break
                         size += len(data)
                         check_size(size)
-                        await run_in_executor(t.write)(data)
-                    return t.name
+                        await run_in_executor(write_chunk)(t, h, data)
+                    return t.name, h.hexdigest()
 
 
 def parse_pages(pages):
@@ -151,6 +231,19 @@ def parse_pages(pages):
             reason='Pages must be a range n-n or "all"')
 
 
+def limit_sprite_pages(pages):
+    "Limits the number of cells of a sprite, even if MAX_PAGES does not."
+    if not MAX_SPRITE_PAGES:
+        return pages
+
+    first, last = pages
+    first = first or 1
+    # A last page of 0 means the rest of the document.
+    if not last or last - first >= MAX_SPRITE_PAGES:
+        last = first + MAX_SPRITE_PAGES - 1
+    return first, last
+
+
 class PreviewResponse(web.FileResponse):
     def __init__(self, obj, *args, **kwargs):
         self._obj = obj
@@ -178,23 +271,23 @@ async def get_path(request):
     path = data.get('path')
     file = data.get('file')
     url = data.get('url')
+    digest = None
 
     if path:
         # TODO: sanitize this path, ensure it is rooted in FILE_ROOT
-        origin = path
-        path = normpath(path)
-        path = pathjoin(FILE_ROOT, path)
+        path, origin = resolve_path(path)
         if not isfile(path):
             raise web.HTTPBadRequest(reason='Invalid path')
 
         check_size(getsize(path))
 
     elif file:
-        origin = path = await upload(file)
+        path, digest = await upload(file)
+        origin = path
 
     elif url:
         origin = url
-        path = await download(url)
+        path, digest = await download(url)
 
     else:
         raise web.HTTPBadRequest(reason='No path, file or url provided')
@@ -202,7 +295,7 @@ async def get_path(request):
     if not isfile(path):
         raise web.HTTPNotFound()
 
-    return path, origin
+    return path, origin, digest
 
 
 async def get_params(request):
@@ -224,6 +317,8 @@ async def get_params(request):
     height = int(data.get('height', DEFAULT_HEIGHT))
     width, height = min(width, MAX_WIDTH), min(height, MAX_HEIGHT)
     pages = parse_pages(data.get('pages'))
+    if format == 'sprite':
+        pages = limit_sprite_pages(pages)
 
     store = None
     if 'pvs-store-disabled' in request.headers:
@@ -239,13 +334,17 @@ async def get_params(request):
 
 def make_handler(f):
     # Sets up an HTTP handler, uses f to extract parameters. f() is expected
-    # to return a tuple of (path, origin).
+    # to return a tuple of (path, origin) or (path, origin, digest).
     async def handler(request):
         # It is fairly safe to read these arguments first.
         width, height, format, name, args = await get_params(request)
+        etag = last_modified = None
 
         try:
-            path, origin = await f(request)
+            result = await f(request)
+            path, origin = result[:2]
+            # Content digest is optional, it is used for storage keys.
+            digest = result[2] if len(result) > 2 else None
 
         except Exception as e:
             LOGGER.exception('Failed to get path and origin')
@@ -259,7 +358,17 @@ def make_handler(f):
 
         else:
             obj = PreviewModel(path, width, height, format, origin=origin,
-                               name=name, args=args)
+                               name=name, args=args, digest=digest)
+
+            etag, last_modified = await run_in_executor(get_validators)(obj)
+            if is_not_modified(request, etag, last_modified):
+                # The client has the current preview, no need to generate
+                # or send it.
+                await run_in_executor(obj.cleanup)()
+                response = web.Response(status=304)
+                set_validators(response, etag, last_modified)
+                set_cache_control(response)
+                return response
 
             try:
                 await generate(obj)
@@ -280,9 +389,12 @@ def make_handler(f):
             except Exception as e:
                 # For any other error, log it and produce a file-type icon if
                 # possible.
-                if not isinstance(e, UnsupportedTypeError):
+                if not isinstance(e, (UnsupportedTypeError, CircuitOpenError)):
                     LOGGER.exception(e)
 
+                # The icon should not be cached as the preview.
+                etag = last_modified = None
+
                 # Attempt to get a file type icon.
                 if not await icons.get(obj):
                     # If no icon could be located, raise an exception.
@@ -290,7 +402,13 @@ def make_handler(f):
                         reason='Unrecoverable error')
 
         if BASE_PATH is None or obj.dst.is_temp or not X_ACCEL_REDIR:
-            response = PreviewResponse(obj)
+            if isinstance(obj.dst, BufferModel):
+                # Preview was served from the memory store.
+                response = web.Response(body=obj.dst.data)
+                response.content_type = obj.content_type
+
+            else:
+                response = PreviewResponse(obj)
 
         else:
             x_accel_path = chroot(obj.dst.path, BASE_PATH, X_ACCEL_REDIR)
@@ -298,6 +416,16 @@ def make_handler(f):
             response.headers['X-Accel-Redirect'] = x_accel_path
             response.content_type = obj.content_type
 
+        if obj.format == 'sprite':
+            response.headers[SPRITE_MAP_HEADER] = await run_in_executor(
+                get_sprite_map)(obj)
+
+        if not isinstance(response, PreviewResponse):
+            # PreviewResponse cleans up after sending the file, otherwise
+            # temporary files must be removed here.
+            await run_in_executor(obj.cleanup)()
+
+        set_validators(response, etag, last_modified)
         set_cache_control(response)
 
         return response
@@ -340,6 +468,31 @@ async def info(request):
     return web.Response(text=code.getvalue())
 
 
+async def document_info(request):
+    """
+    Describes a document (path, file or url): its type, the number of pages
+    and the size of each page.
+    """
+    path, origin, digest = await get_path(request)
+    obj = PreviewModel(path, 0, 0, 'info', origin=origin, digest=digest,
+                       args={'pages': (0, 0)})
+    try:
+        return web.json_response(await get_info(obj))
+
+    except UnsupportedTypeError:
+        raise web.HTTPBadRequest(reason='Unsupported file type')
+
+    except CircuitOpenError:
+        raise web.HTTPServiceUnavailable(reason='Office conversions failing')
+
+    except Exception as e:
+        LOGGER.exception(e)
+        raise web.HTTPInternalServerError(reason='Could not read document')
+
+    finally:
+        await run_in_executor(obj.cleanup)()
+
+
 async def test(request):
     return web.FileResponse(pathjoin(ROOT, 'html/test.html'))
 
@@ -363,6 +516,9 @@ def get_app():
         web.get('/preview/', default_handler)])
     # Some views not related to generating previews.
     app.add_routes([web.get('/', info)])
+    app.add_routes([
+        web.post('/info/', document_info),
+        web.get('/info/', document_info)])
     app.add_routes([web.get('/test/', test)])
     app.add_routes([web.get('/metrics/', metrics_handler)])
 
@@ -1,8 +1,20 @@
+import os
+import sys
+import logging
+
+from os.path import join as pathjoin
+
 from aiohttp import web
 
 from preview import get_app, LOOP
+from preview.backends import raster
 from preview.storage import Cleanup
-from preview.config import PROFILE_PATH, GID, UID, PORT
+from preview.config import (
+    PROFILE_PATH, GID, UID, PORT, WATCH, BASE_PATH, GHOSTSCRIPT_WORKERS,
+)
+
+
+LOGGER = logging.getLogger()
 
 
 def main():
@@ -11,11 +23,23 @@ def main():
     if UID:
         os.setuid(int(UID))
 
+    # Start ghostscript workers before any threads exist, so that they are
+    # forked from a process that has none.
+    raster.start(GHOSTSCRIPT_WORKERS)
+
+    if sys.argv[1:2] == ['pregenerate']:
+        from preview.pregenerate import main as pregenerate
+        sys.exit(pregenerate(sys.argv[2:], LOOP))
+
     app = get_app()
 
     # TODO: probably a better way...
     Cleanup(LOOP)
 
+    if WATCH and BASE_PATH:
+        from preview.watcher import Watcher
+        Watcher(LOOP)
+
     # TODO: figure out how to wait for pending requests before exiting.
     web.run_app(app, port=PORT)
 
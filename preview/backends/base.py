@@ -1,16 +1,48 @@
-from preview.metrics import CONVERSIONS, CONVERSION_ERRORS
+import threading
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from preview.metrics import (
+    CONVERSIONS, CONVERSION_ERRORS, BACKEND_QUEUED, BACKEND_ACTIVE,
+)
 from preview.errors import InvalidFormatError
+from preview.utils import run_in_executor
+
+
+def make_executor(max_workers):
+    "Returns a dedicated executor, or None to use the loop's default."
+    return ThreadPoolExecutor(max_workers=max_workers) if max_workers \
+        else None
+
+
+class Queued(object):
+    "Counts a preview as queued until it starts or is abandoned."
+    def __init__(self, backend):
+        self.gauge = BACKEND_QUEUED.labels(backend)
+        self.queued = True
+        self._lock = threading.Lock()
+        self.gauge.inc()
+
+    def done(self):
+        with self._lock:
+            if not self.queued:
+                return
+            self.queued = False
+        self.gauge.dec()
 
 
 class BaseBackend(object):
     name = None
     extensions = []
     executor = None
+    # Image previews can be produced by resizing a larger image preview.
+    derivable = True
 
     def __init__(self):
         pass
 
-    def preview(self, obj):
+    def get_method(self, obj):
         try:
             method = getattr(self, '_preview_%s' % obj.format)
 
@@ -20,10 +52,47 @@ class BaseBackend(object):
         if not callable(method):
             raise Exception('Unsupported output format: %s' % obj.format)
 
+        return method
+
+    @contextmanager
+    def measure(self, obj):
         try:
             with CONVERSIONS.labels(self.name, obj.extension, obj.format).time():
-                return method(obj)
+                yield
 
         except Exception:
             CONVERSION_ERRORS.labels(self.name, obj.extension, obj.format).inc()
             raise
+
+    def preview(self, obj):
+        method = self.get_method(obj)
+        with self.measure(obj):
+            return method(obj)
+
+    def info(self, obj):
+        """
+        Returns a dict describing obj's source: the number of pages, the size
+        of each page and the units of the sizes. None when unknown.
+        """
+        return {'pages': 1, 'sizes': None, 'units': None}
+
+    async def info_async(self, obj):
+        return await run_in_executor(self.info, self.executor)(obj)
+
+    def _run(self, queued, obj):
+        queued.done()
+        with BACKEND_ACTIVE.labels(self.name).track_inprogress():
+            return self.preview(obj)
+
+    async def preview_async(self, obj):
+        """
+        Produces the preview in the backend's executor, so that a backlog of
+        one type of file does not hold up the others.
+        """
+        queued = Queued(self.name)
+        try:
+            return await run_in_executor(self._run, self.executor)(
+                queued, obj)
+
+        finally:
+            queued.done()
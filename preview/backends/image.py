@@ -10,10 +10,11 @@ import img2pdf
 from rwlock.rwlock import RWLock
 from wand.image import Image, Color, libmagick
 
-from preview.backends.base import BaseBackend
+from preview.backends.base import BaseBackend, make_executor
 from preview.utils import log_duration, safe_remove
 from preview.models import PathModel
 from preview.errors import InvalidPageError
+from preview.config import MAX_IMAGE_WORKERS
 
 
 WAND_LOCK = RWLock()
@@ -21,7 +22,7 @@ LOGGER = logging.getLogger(__name__)
 TMP_PATTERN = 'magick-*'
 
 
-def resize_image(path, width, height):
+def resize_image(path, width, height, suffix='.gif'):
     with WAND_LOCK.reader_lock, Image(width=width, height=height) as bg:
         # Resize our input image.
         with Image(filename=path, resolution=300) as s:
@@ -34,7 +35,7 @@ def resize_image(path, width, height):
             top = (bg.height - d.height) // 2
             bg.composite(d, left, top, operator='over')
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.gif') as t:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as t:
             bg.save(filename=t.name)
             return t.name
 
@@ -91,6 +92,14 @@ class ImageBackend(BaseBackend):
         'ttf', 'ubrl', 'ubrl6', 'uil', 'viff', 'wbmp', 'wbmp', 'wdp', 'wmf',
         'wpg', 'x', 'xbm', 'xcf', 'xwd', 'x3f', 'yuv', 'xpm',
     ]
+    executor = make_executor(MAX_IMAGE_WORKERS)
+
+    def info(self, obj):
+        # Only the image's attributes are read.
+        with WAND_LOCK.reader_lock, Image.ping(filename=obj.src.path) as img:
+            return {
+                'pages': 1, 'sizes': [[img.width, img.height]], 'units': 'px',
+            }
 
     @log_duration
     def _preview_image(self, obj, pages=None):
@@ -112,3 +121,14 @@ class ImageBackend(BaseBackend):
         self._preview_image(obj)
         path = convert_to_pdf(obj.dst.path)
         obj.dst = PathModel(path)
+
+    @log_duration
+    def _preview_sprite(self, obj, pages=None):
+        if pages is None:
+            pages = obj.args.get('pages')
+        # An image is a single page sprite.
+        if pages[0] not in (0, 1):
+            raise InvalidPageError(pages)
+
+        path = resize_image(obj.src.path, obj.width, obj.height, '.png')
+        obj.dst = PathModel(path)
@@ -1,61 +1,366 @@
+import os
+import atexit
+import shutil
+import asyncio
 import logging
+import zipfile
+import threading
 import subprocess
 
-from tempfile import NamedTemporaryFile
-from concurrent.futures import ThreadPoolExecutor
+from time import time
+from collections import defaultdict
+
+from tempfile import NamedTemporaryFile, mkstemp, gettempdir
+from concurrent import futures
 from runpy import run_path
+from io import BytesIO
+
+from PIL import Image
 
-from preview.backends.base import BaseBackend
-from preview.backends.pdf import PdfBackend
-from preview.utils import log_duration
+from preview.backends.base import BaseBackend, Queued
+from preview.backends.pdf import PdfBackend, pdf_info
+from preview.backends.image import resize_image
+from preview.utils import (
+    log_duration, safe_remove, run_in_executor, Latencies, CircuitBreaker,
+    SingleFlight,
+)
+from preview.metrics import (
+    SOFFICE_IN_FLIGHT, SOFFICE_EJECTIONS, SOFFICE_HEDGES, SOFFICE_REJECTED,
+    BACKEND_ACTIVE, OFFICE_THUMBNAILS as OFFICE_THUMBNAILS_SERVED,
+)
 from preview.config import (
-    SOFFICE_ADDR, SOFFICE_PORT, SOFFICE_TIMEOUT, SOFFICE_RETRY, MAX_OFFICE_WORKERS
+    SOFFICE_ENDPOINTS, SOFFICE_TIMEOUT, SOFFICE_RETRY, SOFFICE_EJECT,
+    SOFFICE_HEDGE, SOFFICE_TIMEOUT_MAX, SOFFICE_BREAKER,
+    SOFFICE_BREAKER_COOLDOWN, SOFFICE_SCRATCH, OFFICE_THUMBNAILS,
+    MAX_OFFICE_WORKERS, STORE_OFFICE_PDF, SOFFICE_UNO_CONNECTIONS,
+    SOFFICE_WORKERS, SOFFICE_WORKER_PORT, SOFFICE_WORKER_JOBS,
+    SOFFICE_WORKER_RSS,
 )
 from preview.models import PathModel
-from preview.errors import InvalidPageError
+from preview.errors import InvalidPageError, CircuitOpenError
+from preview import storage
 
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
-TEXT_FORMATS = [
-    'log',
-]
 FMTS = run_path('/usr/local/bin/unoconv')['fmts']
+# Thumbnails embedded in OOXML and ODF documents.
+THUMBNAILS = [
+    'docProps/thumbnail.jpeg', 'docProps/thumbnail.jpg',
+    'docProps/thumbnail.png', 'Thumbnails/thumbnail.png',
+]
+THUMBNAIL_EXTENSIONS = [
+    'docx', 'docm', 'dotx', 'dotm', 'xlsx', 'xlsm', 'xltx', 'xltm', 'pptx',
+    'pptm', 'ppsx', 'potx', 'odt', 'ott', 'ods', 'ots', 'odp', 'otp', 'odg',
+]
+# Where soffice reads and writes files by path, local workers share our
+# filesystem.
+SCRATCH = gettempdir() if SOFFICE_WORKERS else SOFFICE_SCRATCH
+# Errors after which an endpoint is ejected.
+EJECT_ERRORS = (asyncio.TimeoutError, futures.TimeoutError)
+# Recent conversions needed before hedging.
+HEDGE_MIN_SAMPLES = 20
+# Whole documents (pages (0, 0)) take longer than single pages, so the times
+# of each kind of conversion are kept apart, keyed by whole.
+LATENCIES = defaultdict(Latencies)
+# Recent conversion times and times per byte, by (extension, whole).
+DURATIONS = defaultdict(Latencies)
+RATES = defaultdict(Latencies)
+# Conversions needed before their times are used for timeouts.
+TIMEOUT_MIN_SAMPLES = 10
+# Files must be at least this large for their time per byte to be recorded,
+# time spent on smaller files is mostly overhead.
+RATE_MIN_SIZE = 1024 ** 2
+# Time per byte assumed until enough conversions are recorded (1s per MB).
+DEFAULT_RATE = 1.0 / 1024 ** 2
+# Allowance over the expected conversion time.
+TIMEOUT_FACTOR = 2
+BREAKER = CircuitBreaker(SOFFICE_BREAKER / 100, SOFFICE_BREAKER_COOLDOWN) \
+    if SOFFICE_BREAKER else None
+# Whole documents currently being converted, by intermediate key.
+DOCUMENTS_IN_FLIGHT = SingleFlight()
+
+
+class Endpoint(object):
+    "A soffice server, optionally reached through a pool of connections."
+    def __init__(self, addr, port, pool=None):
+        self.addr = addr
+        self.port = port
+        self.pool = pool
+        self.in_flight = 0
+        self.last_used = 0
+        self.ejected = 0
+        self.gauge = SOFFICE_IN_FLIGHT.labels(str(self))
+
+    def __str__(self):
+        return '%s:%i' % (self.addr, self.port)
+
+
+class Router(object):
+    """
+    Routes each conversion to the endpoint with the fewest conversions in
+    flight.
+
+    Endpoints that time out are ejected for a while, they are only used again
+    when no other endpoint is available.
+    """
+    def __init__(self, endpoints, eject=SOFFICE_EJECT):
+        self.endpoints = endpoints
+        self.eject_for = eject
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        "Returns the least busy endpoint, preferring those not in exclude."
+        now = time()
+        with self._lock:
+            endpoints = [
+                e for e in self.endpoints if e not in exclude
+            ] or self.endpoints
+            endpoints = [e for e in endpoints if e.ejected <= now] or endpoints
+            endpoint = min(endpoints, key=lambda e: (e.in_flight, e.last_used))
+            endpoint.in_flight += 1
+            endpoint.last_used = now
+
+        endpoint.gauge.inc()
+        return endpoint
+
+    def release(self, endpoint):
+        with self._lock:
+            endpoint.in_flight -= 1
+        endpoint.gauge.dec()
+
+    def eject(self, endpoint):
+        LOGGER.warning('Ejecting soffice endpoint %s for %is', endpoint,
+                       self.eject_for or 0)
+        SOFFICE_EJECTIONS.labels(str(endpoint)).inc()
+        endpoint.ejected = time() + (self.eject_for or 0)
+
+
+if SOFFICE_WORKERS:
+    # Requires python3-uno, only imported when enabled.
+    from preview.backends.soffice import WorkerPool, UnavailableError
+    EJECT_ERRORS += (UnavailableError,)
+    pool = WorkerPool(SOFFICE_WORKERS, SOFFICE_WORKER_PORT, SOFFICE_TIMEOUT,
+                      max_jobs=SOFFICE_WORKER_JOBS, max_rss=SOFFICE_WORKER_RSS)
+    atexit.register(pool.close)
+    # Workers are used by the pool as they become idle.
+    ROUTER = Router([Endpoint('127.0.0.1', SOFFICE_WORKER_PORT, pool)])
+
+elif SOFFICE_UNO_CONNECTIONS:
+    from preview.backends.soffice import ConnectionPool, UnavailableError
+    EJECT_ERRORS += (UnavailableError,)
+    ROUTER = Router([
+        Endpoint(addr, port, ConnectionPool(
+            addr, port, SOFFICE_UNO_CONNECTIONS, SOFFICE_TIMEOUT))
+        for addr, port in SOFFICE_ENDPOINTS
+    ])
+
+else:
+    ROUTER = Router([Endpoint(addr, port) for addr, port in SOFFICE_ENDPOINTS])
+
+# Hedging requires another soffice to run the duplicate conversion.
+HEDGE = SOFFICE_HEDGE \
+    if len(ROUTER.endpoints) > 1 or SOFFICE_WORKERS > 1 else 0
+# Limits concurrent conversions, created when first used so that it belongs
+# to the running loop.
+SEMAPHORE = None
+
+
+def get_timeout(extension, size, whole=False):
+    """
+    Returns the timeout for converting a file. When PVS_SOFFICE_TIMEOUT_MAX is
+    set, the timeout is scaled from the size of the file and recent
+    conversions of the same type, whole documents or pages.
+    """
+    if not SOFFICE_TIMEOUT_MAX:
+        return SOFFICE_TIMEOUT
+
+    key = (extension, whole)
+    durations, rates = DURATIONS[key], RATES[key]
+    rate = rates.percentile(95) if len(rates) >= TIMEOUT_MIN_SAMPLES \
+        else DEFAULT_RATE
+    timeout = max(SOFFICE_TIMEOUT, TIMEOUT_FACTOR * rate * size)
+
+    if len(durations) >= TIMEOUT_MIN_SAMPLES:
+        timeout = max(timeout, TIMEOUT_FACTOR * durations.percentile(95))
+
+    return min(timeout, SOFFICE_TIMEOUT_MAX)
+
+
+def _scratch_file(suffix):
+    "Creates an empty file in SCRATCH, returns its path."
+    fd, path = mkstemp(suffix=suffix, dir=SCRATCH)
+    os.close(fd)
+    if SCRATCH != gettempdir():
+        # soffice may run as a different user.
+        os.chmod(path, 0o666)
+    return path
+
+
+def _temp_file(pdf):
+    "Returns the path of a temporary file containing pdf (contents or path)."
+    if isinstance(pdf, bytes):
+        with NamedTemporaryFile(delete=False, suffix='.pdf') as t:
+            t.write(pdf)
+        return t.name
 
+    if SCRATCH == gettempdir():
+        return pdf
 
-def convert(obj, retry=SOFFICE_RETRY, pages=(1, 1)):
+    with NamedTemporaryFile(delete=False, suffix='.pdf') as t:
+        pass
+    shutil.move(pdf, t.name)
+    return t.name
+
+
+async def _unoconv(endpoint, path, file_data, format, pages, timeout,
+                   output=None):
     cmd = [
-        'unoconv', '--server=%s' % SOFFICE_ADDR, '--port=%s' % SOFFICE_PORT,
-        '--stdout',
+        'unoconv', '--server=%s' % endpoint.addr, '--port=%s' % endpoint.port,
     ]
 
+    if output is None:
+        cmd.append('--stdout')
+
+    else:
+        cmd.append('--output=%s' % output)
+
     if pages != (0, 0):
         cmd.extend(['-e', 'PageRange=%i-%i' % pages])
 
-    # Give a hint at which input filter to use. The file name passed to unoconv
-    # may not have an extension.
-    format = FMTS.byextension('.%s' % obj.src.extension)
     if format:
-        cmd.extend(['-I', format[0].name])
+        cmd.extend(['-I', format.name])
 
-    file_data = None
-    if obj.src.is_shared:
-        cmd.append(obj.src.path)
+    if file_data is None:
+        cmd.append(path)
 
     else:
         cmd.append('--stdin')
-        with open(obj.src.path, 'rb') as f:
-            file_data = f.read()
 
     LOGGER.debug('unoconv cmd: %s' % cmd)
 
+    p = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            p.communicate(file_data), timeout)
+
+    except BaseException:
+        # Timed out or cancelled (hedging), the process is no longer needed.
+        if p.returncode is None:
+            p.kill()
+            await p.wait()
+        raise
+
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd, stdout, stderr)
+
+    return stdout if output is None else output
+
+
+async def _uno(endpoint, path, file_data, format, pages, timeout,
+               output=None):
+    # The UNO bridge blocks, conversions are made by the pool's threads, one
+    # per connection, so that a backlog does not occupy other threads.
+    future = endpoint.pool.executor.submit(
+        endpoint.pool.convert, path, file_data,
+        format.filter if format else None, pages, timeout, output)
+    try:
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    except asyncio.CancelledError:
+        # A conversion that has started can not be interrupted, discard its
+        # result.
+        if not future.cancel():
+            future.add_done_callback(_discard)
+        raise
+
+
+def _discard(future):
+    "Removes the PDF produced by an abandoned conversion."
+    if not future.cancelled() and future.exception() is None and \
+       isinstance(future.result(), str):
+        safe_remove(future.result())
+
+
+@run_in_executor
+def _read_input(obj):
+    """
+    Returns a tuple of (path, file_data, scratch) describing how soffice
+    receives the file.
+    """
+    path, file_data, scratch = obj.src.path, None, None
+    if not obj.src.is_shared and not SOFFICE_WORKERS:
+        if SOFFICE_SCRATCH:
+            # soffice reads the file from the scratch directory.
+            path = scratch = _scratch_file('.%s' % obj.src.extension)
+            shutil.copyfile(obj.src.path, path)
+
+        else:
+            # soffice can not reach the file, it is sent to soffice instead.
+            with open(obj.src.path, 'rb') as f:
+                file_data = f.read()
+
+    return path, file_data, scratch
+
+
+async def _convert(obj, retry, pages, tried):
+    """
+    Converts obj to PDF, returns the path of a temporary file containing the
+    PDF.
+    """
+    # Give a hint at which input filter to use. The file name passed to soffice
+    # may not have an extension.
+    extension = obj.src.extension
+    format = FMTS.byextension('.%s' % extension)
+    format = format[0] if format else None
+
+    path, file_data, scratch = await _read_input(obj)
+    size = obj.src.size if file_data is None else len(file_data)
+    timeout = get_timeout(extension, size, pages == (0, 0))
+
+    try:
+        return await _attempt(extension, path, file_data, format, size,
+                              timeout, retry, pages, tried)
+
+    finally:
+        if scratch is not None:
+            safe_remove(scratch)
+
+
+async def _attempt(extension, path, file_data, format, size, timeout, retry,
+                   pages, tried):
     while True:
+        # Retries go to a different endpoint when possible.
+        endpoint = ROUTER.acquire(exclude=tried)
+        tried.append(endpoint)
+        # soffice writes the PDF to the scratch directory if possible,
+        # otherwise it is returned in memory.
+        output = _scratch_file('.pdf') if SCRATCH else None
+        start = time()
         try:
-            p = subprocess.run(cmd, input=file_data, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE, timeout=SOFFICE_TIMEOUT,
-                               check=True)
+            f = _unoconv if endpoint.pool is None else _uno
+            pdf = await f(
+                endpoint, path, file_data, format, pages, timeout, output)
+
+            duration, whole = time() - start, pages == (0, 0)
+            LATENCIES[whole].add(duration)
+            DURATIONS[extension, whole].add(duration)
+            if size >= RATE_MIN_SIZE:
+                RATES[extension, whole].add(duration / size)
+
+            output = None
+            return await run_in_executor(_temp_file)(pdf)
 
-            return p.stdout
+        except (InvalidPageError, asyncio.CancelledError):
+            raise
+
+        except EJECT_ERRORS as e:
+            ROUTER.eject(endpoint)
+            if not retry:
+                raise
+            LOGGER.debug('%s timed out, retrying: %s', endpoint, e)
 
         except subprocess.CalledProcessError as e:
             if pages not in ((0, 0), (1, 1)):
@@ -77,17 +382,204 @@ def convert(obj, retry=SOFFICE_RETRY, pages=(1, 1)):
             LOGGER.debug('unoconv failed, retrying: %s', e, exc_info=True)
 
         finally:
+            ROUTER.release(endpoint)
+            if output is not None:
+                safe_remove(output)
             retry -= 1
 
 
+def get_hedge_delay(whole=False):
+    "Returns how long to wait before hedging a conversion, or None."
+    latencies = LATENCIES[whole]
+    if not HEDGE or len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return latencies.percentile(HEDGE)
+
+
+async def _hedge(obj, retry, pages):
+    delay, tried = get_hedge_delay(pages == (0, 0)), []
+    if delay is None:
+        return await _convert(obj, retry, pages, tried)
+
+    # Both attempts share tried, so each goes to a different endpoint.
+    first = asyncio.ensure_future(_convert(obj, retry, pages, tried))
+    done, pending = await asyncio.wait([first], timeout=delay)
+    if not done:
+        # Slower than most conversions, start another on a different endpoint
+        # and use whichever finishes first.
+        LOGGER.debug('Hedging conversion of %r after %.2fs', obj, delay)
+        SOFFICE_HEDGES.inc()
+        pending.add(asyncio.ensure_future(_convert(obj, 0, pages, tried)))
+
+    try:
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+
+            # Once both attempts have failed, the first attempt's error is
+            # raised.
+            if not pending:
+                return first.result()
+
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+
+    finally:
+        for future in pending:
+            future.cancel()
+            future.add_done_callback(_discard)
+
+
+async def convert(obj, retry=SOFFICE_RETRY, pages=(1, 1)):
+    """
+    Converts obj to PDF using soffice. Returns the path of a temporary file
+    containing the PDF.
+    """
+    global SEMAPHORE
+
+    token = BREAKER.allow() if BREAKER is not None else None
+    if BREAKER is not None and token is None:
+        # Fail fast, the caller falls back to an icon.
+        SOFFICE_REJECTED.inc()
+        raise CircuitOpenError('Office conversions are failing')
+
+    if SEMAPHORE is None and MAX_OFFICE_WORKERS:
+        SEMAPHORE = asyncio.Semaphore(MAX_OFFICE_WORKERS)
+
+    success = False
+    try:
+        if SEMAPHORE is None:
+            pdf = await _hedge(obj, retry, pages)
+
+        else:
+            queued = Queued('office')
+            try:
+                async with SEMAPHORE:
+                    queued.done()
+                    pdf = await _hedge(obj, retry, pages)
+
+            finally:
+                queued.done()
+
+        success = True
+        return pdf
+
+    except InvalidPageError:
+        # soffice is working.
+        success = True
+        raise
+
+    finally:
+        if BREAKER is not None:
+            BREAKER.record(token, success)
+
+
+def extract_thumbnail(obj):
+    """
+    Returns the path of a temporary file containing the thumbnail embedded in
+    the document, if it is large enough for the requested size. Otherwise
+    returns None.
+    """
+    if obj.src.extension not in THUMBNAIL_EXTENSIONS:
+        return
+
+    try:
+        with zipfile.ZipFile(obj.src.path) as z:
+            names = set(z.namelist())
+            for name in THUMBNAILS:
+                if name in names:
+                    break
+
+            else:
+                return
+
+            # Thumbnails are small, zip members are not seekable in python
+            # 3.6.
+            data = z.read(name)
+
+        with Image.open(BytesIO(data)) as image:
+            width, height = image.size
+
+    except (zipfile.BadZipFile, OSError) as e:
+        LOGGER.debug('Could not read thumbnail of %r: %s', obj, e)
+        return
+
+    # Thumbnails are only scaled down.
+    if width < obj.width and height < obj.height:
+        LOGGER.debug('Thumbnail of %r is too small: %ix%i', obj, width, height)
+        return
+
+    with NamedTemporaryFile(
+            delete=False, suffix='.%s' % name.rpartition('.')[2]) as t:
+        t.write(data)
+        return t.name
+
+
+async def _store_document(key, obj):
+    path = await run_in_executor(storage.get_intermediate)(key, obj)
+    if path is not None:
+        return path
+
+    start = time()
+    path = await convert(obj, pages=(0, 0))
+
+    stored = await run_in_executor(storage.put_intermediate)(
+        key, obj, path, cost=time() - start)
+    if stored == path:
+        # The store is full. Requests sharing this conversion can not tell
+        # when the PDF is no longer needed, so it is not kept.
+        await run_in_executor(safe_remove)(path)
+        return
+
+    return stored
+
+
+async def get_document(obj):
+    """
+    Returns the path of a stored PDF of the whole document, converting it if
+    necessary. Returns None if the PDF should not be stored.
+
+    Concurrent requests for the same document share one conversion.
+    """
+    if not STORE_OFFICE_PDF:
+        return
+
+    key = storage.get_intermediate_key(obj, 'pdf')
+    if key is None:
+        return
+
+    path, _ = await DOCUMENTS_IN_FLIGHT(key, _store_document, key, obj)
+    return path
+
+
+async def convert_document(obj):
+    """
+    Like get_document(), but returns None if the whole document could not be
+    converted, so that the caller converts only the pages it needs.
+
+    Any page, size or format can be produced from the stored PDF without
+    another round-trip to soffice.
+    """
+    try:
+        return await get_document(obj)
+
+    except asyncio.CancelledError:
+        raise
+
+    except Exception as e:
+        LOGGER.warning('Could not convert %r in full, converting pages: %s',
+                       obj, e)
+
+
 class OfficeBackend(BaseBackend):
     name = 'office'
     extensions = [
         # https://en.wikipedia.org/wiki/LibreOffice#Supported_file_formats
         'dot', 'docm', 'dotx', 'dotm', 'psw', 'doc', 'xls', 'ppt', 'wpd',
-        'wps', 'csv', 'sdw', 'sgl', 'vor', 'docx', 'xlsx', 'pptx', 'xlsm',
+        'wps', 'sdw', 'sgl', 'vor', 'docx', 'xlsx', 'pptx', 'xlsm',
         'xltx', 'xltm', 'xlt', 'xlw', 'dif', 'rtf', 'pxl', 'pps', 'ppsx',
-        'odt', 'ods', 'odp', 'log', 'txt', 'abw', 'zabw', 'cwk', 'hwp',
+        'odt', 'ods', 'odp', 'abw', 'zabw', 'cwk', 'hwp',
         'jtd', 'jtt', 'psw', 'wri', '602', 'wpd', 'wps', 'pmd', 'pm3', 'pm4',
         'pm5', 'pm6', 'p65', 'pub', 'qxp', 'html', 'htm', 'fb2', 'rfl',
         # Though listed, epub does not seem to be supported...
@@ -95,22 +587,89 @@ class OfficeBackend(BaseBackend):
         # Calibre could possibly be used in a separate backend for conversion
         # from epub to pdf.
     ]
-    executor = ThreadPoolExecutor(max_workers=MAX_OFFICE_WORKERS) \
-        if MAX_OFFICE_WORKERS else None
+    # Ghostscript and ImageMagick work competes with PDF previews.
+    executor = PdfBackend.executor
+
+    async def preview_async(self, obj):
+        # soffice is awaited on the loop rather than occupying a thread, the
+        # remaining work (ghostscript, ImageMagick) is done in the executor.
+        # Waiting for soffice is counted as queued by convert().
+        method = self.get_method(obj)
+        with self.measure(obj), \
+                BACKEND_ACTIVE.labels(self.name).track_inprogress():
+            return await method(obj)
+
+    async def info_async(self, obj):
+        # The stored PDF is used if there is one, otherwise the whole
+        # document is converted for the occasion.
+        path = await get_document(obj)
+        temp = path is None
+        if temp:
+            path = await convert(obj, pages=(0, 0))
+
+        try:
+            return await run_in_executor(pdf_info, self.executor)(path)
+
+        finally:
+            if temp:
+                await run_in_executor(safe_remove)(path)
 
     @log_duration
-    def _preview_pdf(self, obj):
-        with NamedTemporaryFile(delete=False, suffix='.pdf') as t:
-            t.write(convert(obj, pages=obj.args.get('pages')))
-            obj.dst = PathModel(t.name)
+    async def _preview_pdf(self, obj):
+        path = await convert_document(obj)
+        if path is not None:
+            obj.src = PathModel(path)
+            return await run_in_executor(
+                PdfBackend()._preview_pdf, self.executor)(obj)
+
+        obj.dst = PathModel(await convert(obj, pages=obj.args.get('pages')))
 
     @log_duration
-    def _preview_image(self, obj):
-        with NamedTemporaryFile(delete=False, suffix='.pdf') as t:
-            t.write(convert(obj, pages=obj.args.get('pages')))
-            obj.src = PathModel(t.name)
+    async def _preview_image(self, obj):
+        if OFFICE_THUMBNAILS and obj.args.get('pages') == (1, 1):
+            if await run_in_executor(
+                    self._preview_thumbnail, self.executor)(obj):
+                return
+
+        path = await convert_document(obj)
+        if path is not None:
+            # The PDF contains all pages, ghostscript selects the page.
+            obj.src = PathModel(path)
+            return await run_in_executor(
+                PdfBackend()._preview_image, self.executor)(obj)
+
+        obj.src = PathModel(await convert(obj, pages=obj.args.get('pages')))
 
         # We need to override the pages parameter since the pdf we just
         # generated contains only the pages we want, we don't need to further
         # limit pages.
-        PdfBackend()._preview_image(obj, pages=(0, 0))
+        await run_in_executor(PdfBackend()._preview_image, self.executor)(
+            obj, pages=(0, 0))
+
+    @log_duration
+    async def _preview_sprite(self, obj):
+        path = await convert_document(obj)
+        if path is not None:
+            obj.src = PathModel(path)
+            return await run_in_executor(
+                PdfBackend()._preview_sprite, self.executor)(obj)
+
+        obj.src = PathModel(await convert(obj, pages=obj.args.get('pages')))
+
+        # The pdf contains only the requested pages.
+        await run_in_executor(PdfBackend()._preview_sprite, self.executor)(
+            obj, pages=(0, 0))
+
+    def _preview_thumbnail(self, obj):
+        path = extract_thumbnail(obj)
+        if path is None:
+            return False
+
+        OFFICE_THUMBNAILS_SERVED.inc()
+        try:
+            obj.dst = PathModel(resize_image(path, obj.width, obj.height))
+
+        finally:
+            safe_remove(path)
+
+        return True
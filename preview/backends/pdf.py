@@ -1,20 +1,26 @@
+import os
+import shutil
 import logging
+import functools
 
-from io import BytesIO
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
+from os.path import getsize
+from os.path import join as pathjoin
 
-import ghostscript
+from PIL import Image
 
-from preview.backends.base import BaseBackend
+from preview.backends.base import BaseBackend, make_executor
 from preview.backends.image import ImageBackend
-from preview.utils import log_duration
+from preview.backends import raster
+from preview.backends.raster import run_ghostscript
+from preview.utils import log_duration, safe_remove
 from preview.models import PathModel
 from preview.errors import InvalidPageError
+from preview.config import MAX_PDF_WORKERS, PDF_ENGINE
 
 
 LOGGER = logging.getLogger(__name__)
 
-
 def _calc_dpi(width, height):
     "Calculate DPI necessary to produce a clear image of requested resolution"
     # Since we are dealing with documents, I am going to assume a paper size of
@@ -28,11 +34,125 @@ def _calc_dpi(width, height):
     return (dpi, dpi)
 
 
-def _run_ghostscript(obj, device, outfile, pages=(1, 1)):
+def is_pdf(path):
+    "Returns True if the file at path is a PDF, whatever its name."
+    # Readers accept the header anywhere in the first 1024 bytes.
+    with open(path, 'rb') as f:
+        return b'%PDF-' in f.read(1024)
+
+
+@functools.lru_cache(maxsize=256)
+def _get_page_sizes(path, mtime, size):
+    return tuple(raster.page_sizes(path))
+
+
+def get_page_sizes(path):
+    """
+    Returns the (width, height) of each page of the PDF at path, in points
+    and accounting for rotation. Sizes are cached until the file changes.
+    """
+    st = os.stat(path)
+    return _get_page_sizes(path, st.st_mtime, st.st_size)
+
+
+def pdf_info(path):
+    "Returns the pages of the PDF at path and their sizes."
+    sizes = get_page_sizes(path)
+    return {
+        'pages': len(sizes),
+        'sizes': [[round(w, 2), round(h, 2)] for w, h in sizes],
+        'units': 'pt',
+    }
+
+
+if PDF_ENGINE not in raster.ENGINES:
+    raise ValueError(
+        'PDF engine should be one of: %s' % ', '.join(raster.ENGINES))
+
+ENGINE = PDF_ENGINE
+if ENGINE == 'mupdf' and not raster.mupdf_available():
+    LOGGER.warning('PyMuPDF is not installed, using ghostscript')
+    ENGINE = 'ghostscript'
+
+
+def _render(engine, path, page, width, height, outfile):
+    # Ghostscript reads the size of only the requested page, scanning every
+    # page is left to pdf_info().
+    count = raster.ENGINES[engine](path, page, width, height, outfile)
+
+    if count is None:
+        # The page size could not be determined.
+        return False
+
+    if count < page:
+        raise InvalidPageError((page, page))
+    return True
+
+
+def render_page(path, page, width, height, outfile):
+    """
+    Renders page of the PDF at path to a PNG that fits width x height, using
+    the configured engine. Ghostscript is used if the engine fails.
+    Returns False if the page could not be rendered to size.
+    """
+    if ENGINE != 'ghostscript':
+        try:
+            return _render(ENGINE, path, page, width, height, outfile)
+
+        except InvalidPageError:
+            raise
+
+        except Exception as e:
+            LOGGER.warning('%s failed to render %s, using ghostscript: %s',
+                           ENGINE, path, e, exc_info=True)
+
+    try:
+        return _render('ghostscript', path, page, width, height, outfile)
+
+    except InvalidPageError:
+        raise
+
+    except Exception as e:
+        LOGGER.warning('Could not render %s to size: %s', path, e)
+        return False
+
+
+def _to_gif(path, width, height):
+    "Centers the image at path on a white background and saves it as GIF."
+    with Image.open(path) as image:
+        bg = Image.new('RGB', (width, height), 'white')
+        bg.paste(image, ((width - image.width) // 2,
+                         (height - image.height) // 2))
+
+    with NamedTemporaryFile(delete=False, suffix='.gif') as t:
+        bg.convert('P', palette=Image.ADAPTIVE).save(t.name, 'GIF')
+        return t.name
+
+
+def _to_sprite(paths, width, height):
+    """
+    Fits each image at paths to width x height and stacks them vertically.
+    Saves the result as PNG.
+    """
+    sprite = Image.new('RGB', (width, height * len(paths)), 'white')
+    for i, path in enumerate(paths):
+        with Image.open(path) as image:
+            image.thumbnail((width, height), Image.LANCZOS)
+            sprite.paste(image, ((width - image.width) // 2,
+                                 i * height + (height - image.height) // 2))
+
+    with NamedTemporaryFile(delete=False, suffix='.png') as t:
+        sprite.save(t.name, 'PNG')
+        return t.name
+
+
+def _run_ghostscript(path, device, outfile, pages=(1, 1), dpi=None):
+    "Runs ghostscript on the file at path, rendering pages at dpi."
+
     # An empty file is apparently a valid file as far as ghostscript is
     # concerned. However, it produces an empty image file, which causes
     # errors downline. Detect an empty file and raise here.
-    if not obj.src.size:
+    if not getsize(path):
         raise Exception('Invalid file size 0')
 
     args = [
@@ -44,26 +164,19 @@ def _run_ghostscript(obj, device, outfile, pages=(1, 1)):
         args.extend([
             b'-dFirstPage=%i' % pages[0], b'-dLastPage=%i' % pages[1]])
 
-    # Calculate suitable DPI...
-    dpi = _calc_dpi(obj.width, obj.height)
-    LOGGER.debug('Converting PDF to image with DPI of %ix%i', *dpi)
+    if dpi is not None:
+        LOGGER.debug('Converting PDF to image with DPI of %ix%i', *dpi)
+        args.append(b'-r%ix%i' % dpi)
 
     args.extend([
-        b'-r%ix%i' % dpi,
         b'-o', bytes(outfile, 'utf8'),
-        bytes(obj.src.path, 'utf8'),
+        bytes(path, 'utf8'),
     ])
 
     LOGGER.debug('Ghostscript args: %s', args)
 
-    # TODO: fix this lib. You cannot clean up the object with try / except if
-    # __init__() raises.
-    output = BytesIO()
-    with ghostscript.Ghostscript(stdout=output, stderr=output, *args):
-        pass
-
     # Checkout output for errors that require special handling.
-    output = output.getvalue()
+    output = run_ghostscript(args)
     if pages != (0, 0) and (b'FirstPage' in output or b'LastPage' in output):
         raise InvalidPageError(pages)
 
@@ -74,6 +187,14 @@ class PdfBackend(BaseBackend):
         # https://www.file-extensions.org/ghostscript-file-extensions
         'pdf', 'eps', 'ps', 'pm',
     ]
+    executor = make_executor(MAX_PDF_WORKERS)
+
+    def info(self, obj):
+        # Page sizes are read using ghostscript's PDF interpreter. PostScript
+        # has to be interpreted in full to count its pages.
+        if not is_pdf(obj.src.path):
+            return {'pages': None, 'sizes': None, 'units': None}
+        return pdf_info(obj.src.path)
 
     @log_duration
     def _preview_pdf(self, obj, pages=None):
@@ -84,7 +205,7 @@ class PdfBackend(BaseBackend):
 
         with NamedTemporaryFile(delete=False, suffix='.pdf') as t:
             _run_ghostscript(
-                obj, 'pdfwrite', t.name, pages=pages)
+                obj.src.path, 'pdfwrite', t.name, pages=pages)
             obj.dst = PathModel(t.name)
 
     @log_duration
@@ -98,9 +219,56 @@ class PdfBackend(BaseBackend):
         if pages != (1, 1):
             pages = (pages[0], pages[0])
 
+        # PDF pages can be rendered straight to the requested size, which
+        # avoids rasterizing a large page only to shrink it.
+        # Office documents are stored as PDFs without an extension.
+        if is_pdf(obj.src.path):
+            with NamedTemporaryFile(delete=False, suffix='.png') as t:
+                try:
+                    rendered = render_page(obj.src.path, pages[0] or 1,
+                                           obj.width, obj.height, t.name)
+
+                except Exception:
+                    safe_remove(t.name)
+                    raise
+
+            if rendered:
+                obj.src = PathModel(t.name)
+                obj.dst = PathModel(
+                    _to_gif(obj.src.path, obj.width, obj.height))
+                return
+
+            safe_remove(t.name)
+
         with NamedTemporaryFile(delete=False, suffix='.png') as t:
             _run_ghostscript(
-                obj, 'png16m', t.name, pages=pages)
+                obj.src.path, 'png16m', t.name, pages=pages,
+                dpi=_calc_dpi(obj.width, obj.height))
             obj.src = PathModel(t.name)
 
         ImageBackend()._preview_image(obj, pages=(1, 1))
+
+    @log_duration
+    def _preview_sprite(self, obj, pages=None):
+        # NOTE: pages can be overridden since the pdf backend is called by the
+        # office backend. In that case pages needs to be overidden.
+        if pages is None:
+            pages = obj.args.get('pages')
+
+        # Pages are rendered by a single ghostscript run, one file each.
+        tmp = mkdtemp()
+        try:
+            _run_ghostscript(
+                obj.src.path, 'png16m', pathjoin(tmp, 'page-%d.png'),
+                pages=pages, dpi=_calc_dpi(obj.width, obj.height))
+            paths = [
+                pathjoin(tmp, 'page-%i.png' % i)
+                for i in range(1, len(os.listdir(tmp)) + 1)
+            ]
+            if not paths:
+                raise InvalidPageError(pages)
+
+            obj.dst = PathModel(_to_sprite(paths, obj.width, obj.height))
+
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
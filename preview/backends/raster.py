@@ -0,0 +1,271 @@
+"""
+PDF rasterization engines, run in a pool of worker processes.
+
+The workers isolate the server from ghostscript crashes and memory use. The
+pool is started by start() before the server's threads exist, forking a
+process that has threads is unsafe.
+
+This module does not import the rest of preview-server (or MuPDF unless it
+is used), so that benchmark.py can measure the engines on their own.
+"""
+import atexit
+import logging
+import threading
+import importlib.util
+
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import ghostscript
+
+from PIL import Image
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+POOL = None
+WORKERS = 0
+_POOL_LOCK = threading.Lock()
+_MUPDF_LOCK = threading.Lock()
+
+# Prints the page count, and the size (in points, as displayed) of page Page
+# if it exists: "BOX: count [width height rotate]". The CropBox is used, as
+# it is by -dUseCropBox, falling back to the MediaBox.
+PAGE_BOX_PS = b'''
+File (r) file runpdfbegin
+(BOX: ) print pdfpagecount dup =only
+Page ge {
+  Page pdfgetpage dup /CropBox pget not { dup /MediaBox pget pop } if
+  { oforce } forall 3 -1 roll sub abs 3 1 roll sub abs exch
+  ( ) print exch =only ( ) print =only
+  ( ) print /Rotate pget not { 0 } if =only
+} if
+() = runpdfend quit
+'''
+# Prints the size of every page: "PAGE: width height rotate".
+PAGES_PS = b'''
+File (r) file runpdfbegin
+1 1 pdfpagecount {
+  pdfgetpage dup /CropBox pget not { dup /MediaBox pget pop } if
+  { oforce } forall 3 -1 roll sub abs 3 1 roll sub abs exch
+  (PAGE: ) print exch =only ( ) print =only
+  ( ) print /Rotate pget not { 0 } if =only () =
+} for
+runpdfend quit
+'''
+
+
+class RenderError(Exception):
+    "An error raised in a worker process."
+
+
+def _call(f, *args):
+    # Exceptions are pickled to be raised in the parent. Some (such as
+    # GhostscriptError) can not be unpickled, which breaks the pool, so they
+    # are replaced by a plain error.
+    try:
+        return f(*args)
+
+    except Exception as e:
+        raise RenderError('%s: %s' % (e.__class__.__name__, e))
+
+
+def _ghostscript(args):
+    "Runs ghostscript, returns its output."
+    # TODO: fix this lib. You cannot clean up the object with try / except if
+    # __init__() raises.
+    output = BytesIO()
+    with ghostscript.Ghostscript(stdout=output, stderr=output, *args):
+        pass
+    return output.getvalue()
+
+
+def _shutdown():
+    if POOL is not None:
+        POOL.shutdown(wait=False)
+
+
+atexit.register(_shutdown)
+
+
+def _make_pool():
+    pool = ProcessPoolExecutor(max_workers=WORKERS)
+    # Worker processes are forked when the first job is submitted.
+    pool.submit(int).result()
+    return pool
+
+
+def start(workers):
+    """
+    Starts workers processes, with 0 ghostscript is run in the calling
+    thread.
+    """
+    global POOL, WORKERS
+
+    WORKERS = workers
+    if workers:
+        POOL = _make_pool()
+
+
+def submit(f, *args):
+    "Calls f in a worker process, returns its result."
+    global POOL
+
+    if not WORKERS:
+        return f(*args)
+
+    with _POOL_LOCK:
+        if POOL is None:
+            # The pool broke, its replacement is forked by a process that
+            # has threads, but that is better than not rendering at all.
+            POOL = _make_pool()
+        pool = POOL
+
+    try:
+        return pool.submit(_call, f, *args).result()
+
+    except BrokenProcessPool:
+        # A worker died (ghostscript crashed), the pool can not be used
+        # again. Replace it for the next job.
+        LOGGER.warning('Ghostscript worker died, restarting pool')
+        with _POOL_LOCK:
+            if POOL is pool:
+                POOL = None
+        pool.shutdown(wait=False)
+        raise
+
+
+def run_ghostscript(args):
+    "Runs ghostscript, returns its output."
+    return submit(_ghostscript, args)
+
+
+def parse_box(fields):
+    "Returns (width, height) as displayed, from width, height and rotation."
+    width, height, rotate = map(float, fields)
+    if int(rotate) % 180:
+        width, height = height, width
+    return width, height
+
+
+def fit(size, width, height):
+    "Scales size (in points) to the largest size that fits width x height."
+    scale = min(width / size[0], height / size[1])
+    return (max(1, int(size[0] * scale)), max(1, int(size[1] * scale)))
+
+
+def page_box(path, page):
+    """
+    Returns the page count of the PDF at path and the (width, height) of
+    page, in points and accounting for rotation. The size is None if page
+    does not exist.
+    """
+    output = run_ghostscript([
+        b'-dNOPAUSE', b'-dBATCH', b'-dSAFER', b'-dNODISPLAY', b'-q',
+        b'-dPage=%i' % page, b'-sFile=%s' % bytes(path, 'utf8'),
+        b'-c', PAGE_BOX_PS,
+    ])
+    lines = [l for l in output.splitlines() if l.startswith(b'BOX:')]
+    if not lines:
+        raise RenderError('Could not read page size of %s' % path)
+
+    count, *box = lines[-1].split()[1:]
+    return int(count), parse_box(box) if box else None
+
+
+def page_sizes(path):
+    """
+    Returns a list of the (width, height) of each page of the PDF at path, in
+    points and accounting for rotation.
+    """
+    output = run_ghostscript([
+        b'-dNOPAUSE', b'-dBATCH', b'-dSAFER', b'-dNODISPLAY', b'-q',
+        b'-sFile=%s' % bytes(path, 'utf8'), b'-c', PAGES_PS,
+    ])
+    sizes = [
+        parse_box(line.split()[1:]) for line in output.splitlines()
+        if line.startswith(b'PAGE:')
+    ]
+    if not sizes:
+        raise RenderError('Could not read pages of %s' % path)
+    return sizes
+
+
+def render_ghostscript(path, page, width, height, outfile, size=None):
+    """
+    Renders page of the PDF at path to a PNG that fits width x height. Size
+    is the page's size in points, if known.
+
+    Returns the page count, the page is only rendered if it exists.
+    """
+    count = None
+    if size is None:
+        count, size = page_box(path, page)
+        if size is None:
+            return count
+
+    if size[0] <= 0 or size[1] <= 0:
+        raise RenderError('Invalid page size %rx%r' % size)
+
+    # The render size keeps the page's aspect ratio, otherwise ghostscript
+    # rotates pages to fit. Anti-aliasing makes up for the lack of
+    # downsampling.
+    output = run_ghostscript([
+        b'-dNOPAUSE', b'-dBATCH', b'-dSAFER', b'-sDEVICE=png16m',
+        b'-dFirstPage=%i' % page, b'-dLastPage=%i' % page,
+        b'-r72', b'-g%ix%i' % fit(size, width, height), b'-dFIXEDMEDIA',
+        b'-dPDFFitPage', b'-dUseCropBox', b'-dTextAlphaBits=4',
+        b'-dGraphicsAlphaBits=4',
+        b'-o', bytes(outfile, 'utf8'), bytes(path, 'utf8'),
+    ])
+    if b'FirstPage' in output or b'LastPage' in output:
+        # The page does not exist.
+        return page - 1
+    return count if count is not None else page
+
+
+def mupdf_available():
+    return importlib.util.find_spec('fitz') is not None
+
+
+def _mupdf(path, page, width, height, outfile):
+    # PyMuPDF is not thread safe, this matters when it is run in-process.
+    with _MUPDF_LOCK:
+        return _mupdf_render(path, page, width, height, outfile)
+
+
+def _mupdf_render(path, page, width, height, outfile):
+    "Returns the page count, the page is only rendered if it exists."
+    import fitz
+
+    doc = fitz.open(path)
+    try:
+        if page > len(doc):
+            return len(doc)
+
+        # The page's rect is its CropBox, rotated as displayed.
+        p = doc[page - 1]
+        scale = min(width / p.rect.width, height / p.rect.height)
+        pix = p.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+        Image.frombytes('RGB', (pix.width, pix.height), pix.samples) \
+            .save(outfile, 'PNG')
+        return len(doc)
+
+    finally:
+        doc.close()
+
+
+def render_mupdf(path, page, width, height, outfile):
+    """
+    Renders page of the PDF at path to a PNG using MuPDF (PyMuPDF). Returns
+    the page count, the page is only rendered if it exists.
+    """
+    return submit(_mupdf, path, page, width, height, outfile)
+
+
+ENGINES = {
+    'ghostscript': render_ghostscript,
+    'mupdf': render_mupdf,
+}
@@ -0,0 +1,388 @@
+import os
+import queue
+import signal
+import logging
+import subprocess
+
+from io import BytesIO
+from time import time, sleep
+from tempfile import gettempdir
+from os.path import getsize
+from os.path import join as pathjoin
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import uno
+import unohelper
+
+from com.sun.star.beans import PropertyValue
+from com.sun.star.io import XOutputStream
+
+from preview.utils import log_duration
+from preview.errors import InvalidPageError
+from preview.metrics import SOFFICE_RECYCLES
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# Export filter by document type, the first supported service wins.
+EXPORT_FILTERS = [
+    ('com.sun.star.text.WebDocument', 'writer_web_pdf_Export'),
+    ('com.sun.star.text.GenericTextDocument', 'writer_pdf_Export'),
+    ('com.sun.star.sheet.SpreadsheetDocument', 'calc_pdf_Export'),
+    ('com.sun.star.presentation.PresentationDocument', 'impress_pdf_Export'),
+    ('com.sun.star.drawing.DrawingDocument', 'draw_pdf_Export'),
+]
+# How long to wait for a new soffice process to accept connections.
+START_TIMEOUT = 60
+
+
+def get_rss(pid):
+    "Returns the resident memory of pid and its descendants in bytes."
+    rss, children = 0, []
+    try:
+        with open('/proc/%i/status' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                    break
+
+        with open('/proc/%i/task/%i/children' % (pid, pid), 'r') as f:
+            children = f.read().split()
+
+    except OSError:
+        pass
+
+    return rss + sum(get_rss(int(child)) for child in children)
+
+
+def make_props(**kwargs):
+    props = []
+    for name, value in kwargs.items():
+        prop = PropertyValue()
+        prop.Name, prop.Value = name, value
+        props.append(prop)
+    return tuple(props)
+
+
+class OutputStream(unohelper.Base, XOutputStream):
+    "Collects the output of a conversion in memory."
+    def __init__(self):
+        self.data = BytesIO()
+
+    def writeBytes(self, seq):
+        self.data.write(seq.value)
+
+    def closeOutput(self):
+        pass
+
+    def flush(self):
+        pass
+
+
+class UnavailableError(Exception):
+    pass
+
+
+class Connection(object):
+    """
+    A long-lived UNO connection to a soffice listener.
+
+    Calls are made on a dedicated thread so that a wedged soffice can be
+    timed out, in which case the connection is abandoned.
+    """
+    def __init__(self, addr, port):
+        self.addr = addr
+        self.port = port
+        self.context = None
+        self.desktop = None
+        self._executor = None
+
+    def __repr__(self):
+        return '<Connection: %s:%i>' % (self.addr, self.port)
+
+    @property
+    def connected(self):
+        return self.desktop is not None
+
+    def _connect(self):
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local)
+        self.context = resolver.resolve(
+            'uno:socket,host=%s,port=%i;urp;StarOffice.ComponentContext' % (
+                self.addr, self.port))
+        self.desktop = self.context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.frame.Desktop', self.context)
+
+    def _ping(self):
+        self.desktop.getComponents()
+
+    def _call(self, f, timeout, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            return self._executor.submit(f, *args).result(timeout=timeout)
+
+        except TimeoutError:
+            # The call can not be interrupted, give up on the connection. The
+            # thread will exit when soffice responds or the socket closes.
+            LOGGER.warning('%r timed out, abandoning connection', self)
+            self.close()
+            raise
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.context = self.desktop = self._executor = None
+
+    def check(self, timeout):
+        "Ensures the connection is alive, reconnecting if necessary."
+        if self.connected:
+            try:
+                return self._call(self._ping, timeout)
+
+            except Exception as e:
+                LOGGER.info('%r failed health check: %s', self, e)
+                self.close()
+
+        try:
+            self._call(self._connect, timeout)
+
+        except Exception as e:
+            self.close()
+            raise UnavailableError(
+                'Could not connect to soffice at %s:%i: %s' % (
+                    self.addr, self.port, e))
+
+    def _convert(self, path, data, import_filter, pages, output):
+        load_props = dict(Hidden=True, ReadOnly=True)
+        if import_filter:
+            load_props['FilterName'] = import_filter
+
+        if data is None:
+            url = uno.systemPathToFileUrl(path)
+
+        else:
+            url = 'private:stream'
+            load_props['InputStream'] = \
+                self.context.ServiceManager \
+                    .createInstanceWithArgumentsAndContext(
+                        'com.sun.star.io.SequenceInputStream',
+                        (uno.ByteSequence(data),), self.context)
+
+        document = self.desktop.loadComponentFromURL(
+            url, '_blank', 0, make_props(**load_props))
+        if document is None:
+            raise Exception('soffice could not load document')
+
+        try:
+            for service, export_filter in EXPORT_FILTERS:
+                if document.supportsService(service):
+                    break
+
+            else:
+                raise Exception('Unsupported document type')
+
+            store_props = dict(FilterName=export_filter)
+            if pages != (0, 0):
+                store_props['FilterData'] = uno.Any(
+                    '[]com.sun.star.beans.PropertyValue',
+                    make_props(PageRange='%i-%i' % pages))
+
+            if output is None:
+                stream = OutputStream()
+                store_props['OutputStream'] = stream
+                url = 'private:stream'
+
+            else:
+                url = uno.systemPathToFileUrl(output)
+
+            # uno.invoke() is necessary to pass FilterData as an Any.
+            uno.invoke(document, 'storeToURL', (
+                url, make_props(**store_props)))
+
+        finally:
+            document.close(True)
+
+        return stream.data.getvalue() if output is None else output
+
+    def convert(self, path, data, import_filter, pages, timeout, output=None):
+        return self._call(
+            self._convert, timeout, path, data, import_filter, pages, output)
+
+
+class Worker(object):
+    "A soffice process owned by preview-server, with its own profile."
+    def __init__(self, n, port):
+        self.n = n
+        self.port = port
+        self.profile = pathjoin(gettempdir(), 'pvs-soffice-%i' % n)
+        self.connection = Connection('127.0.0.1', port)
+        self.process = None
+        self.jobs = 0
+
+    def __repr__(self):
+        return '<Worker: %i, port=%i, jobs=%i>' % (
+            self.n, self.port, self.jobs)
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    @property
+    def rss(self):
+        return get_rss(self.process.pid) if self.running else 0
+
+    def start(self, timeout):
+        LOGGER.info('Starting %r', self)
+        self.process = subprocess.Popen([
+            'soffice', '--headless', '--invisible', '--nologo', '--norestore',
+            '--nodefault', '--nolockcheck',
+            '--accept=socket,host=127.0.0.1,port=%i;urp;' % self.port,
+            '-env:UserInstallation=%s' % uno.systemPathToFileUrl(self.profile),
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True)
+        self.jobs = 0
+
+        start = time()
+        while True:
+            try:
+                self.connection.check(timeout)
+                break
+
+            except UnavailableError:
+                if not self.running or time() - start > START_TIMEOUT:
+                    self.stop()
+                    raise
+                sleep(0.5)
+
+        LOGGER.info('Started %r in %.2fs', self, time() - start)
+
+    def stop(self):
+        self.connection.close()
+        if self.process is None:
+            return
+
+        # soffice is a wrapper script, kill the whole process group.
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+
+        except ProcessLookupError:
+            pass
+
+        self.process.wait()
+        self.process = None
+
+
+class ConnectionPool(object):
+    """
+    A fixed number of connections to a soffice listener.
+
+    Conversions block, callers on a loop submit them to executor, which has
+    a thread per connection. Conversions waiting for a connection then wait
+    in its queue rather than occupying a thread.
+    """
+    def __init__(self, addr, port, size, timeout):
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=size)
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(Connection(addr, port))
+
+    def _convert(self, connection, path, data, import_filter, pages,
+                 timeout, output):
+        # Errors may leave the connection unusable, checking it before
+        # each use reconnects if needed.
+        connection.check(self.timeout)
+        return connection.convert(
+            path, data, import_filter, pages, timeout, output)
+
+    @log_duration
+    def convert(self, path, data=None, import_filter=None, pages=(1, 1),
+                timeout=None, output=None):
+        """
+        Converts the file at path (or data, if given) to PDF. Returns the PDF
+        contents, or if output is given, writes the PDF to it and returns
+        output. Timeout overrides the pool's timeout for the conversion.
+        """
+        timeout = timeout or self.timeout
+        try:
+            connection = self._idle.get(timeout=timeout)
+
+        except queue.Empty:
+            raise UnavailableError('No connection available')
+
+        try:
+            pdf = self._convert(connection, path, data, import_filter, pages,
+                                timeout, output)
+
+        finally:
+            self._idle.put(connection)
+
+        empty = not pdf if output is None else not getsize(output)
+        if empty and pages not in ((0, 0), (1, 1)):
+            # soffice produces nothing when the page range is invalid.
+            raise InvalidPageError(pages)
+
+        return pdf
+
+
+class WorkerPool(ConnectionPool):
+    """
+    A fixed number of soffice processes, each converting one document at a
+    time.
+
+    Workers are started when first used and recycled after max_jobs
+    conversions or once their memory use exceeds max_rss. A worker that
+    times out is killed and started again for the next conversion.
+    """
+    def __init__(self, size, port, timeout, max_jobs=None, max_rss=None):
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.workers = [Worker(n, port + n) for n in range(size)]
+        self.executor = ThreadPoolExecutor(max_workers=size)
+        self._idle = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def _recycle_reason(self, worker):
+        if not worker.running:
+            return None if worker.process is None else 'exited'
+
+        if self.max_jobs and worker.jobs >= self.max_jobs:
+            return 'jobs'
+
+        if self.max_rss and worker.rss > self.max_rss:
+            return 'rss'
+
+    def _convert(self, worker, path, data, import_filter, pages, timeout,
+                 output):
+        reason = self._recycle_reason(worker)
+        if reason:
+            LOGGER.info('Recycling %r: %s', worker, reason)
+            SOFFICE_RECYCLES.labels(reason).inc()
+            worker.stop()
+
+        if not worker.running:
+            worker.start(self.timeout)
+
+        try:
+            pdf = super()._convert(worker.connection, path, data,
+                                   import_filter, pages, timeout, output)
+
+        except TimeoutError:
+            LOGGER.warning('%r timed out, killing', worker)
+            SOFFICE_RECYCLES.labels('timeout').inc()
+            worker.stop()
+            raise
+
+        worker.jobs += 1
+        return pdf
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for worker in self.workers:
+            worker.stop()
@@ -0,0 +1,140 @@
+import logging
+import itertools
+
+from tempfile import NamedTemporaryFile
+
+from PIL import Image, ImageDraw, ImageFont
+
+from preview.backends.base import BaseBackend, make_executor
+from preview.utils import log_duration
+from preview.models import PathModel
+from preview.errors import InvalidPageError
+from preview.config import MAX_TEXT_WORKERS
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+FONT_PATH = '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf'
+# Page geometry in points, US letter with half inch margins and 10pt text.
+PAGE_SIZE = (612, 792)
+MARGIN = 36
+FONT_SIZE = 10
+LINE_HEIGHT = 12
+LINES = (PAGE_SIZE[1] - 2 * MARGIN) // LINE_HEIGHT
+# Monospace glyphs are 0.6em wide.
+COLUMNS = int((PAGE_SIZE[0] - 2 * MARGIN) / (FONT_SIZE * 0.6))
+# PDF pages are rendered at 144 DPI.
+PDF_SCALE = 2
+BORDER_COLOR = (204, 204, 204)
+
+
+def _wrap(f):
+    "Yields lines of f, long lines are broken at COLUMNS."
+    for line in f:
+        line = line.rstrip('\r\n').expandtabs()
+        for i in range(0, max(len(line), 1), COLUMNS):
+            yield line[i:i + COLUMNS]
+
+
+def read_pages(path, pages):
+    """
+    Returns a list of pages (each a list of lines) of the text file at path.
+    Only as much of the file as is needed is read.
+    """
+    first, last = pages
+    if pages == (0, 0):
+        first, last = 1, None
+
+    with open(path, 'r', encoding='utf8', errors='replace') as f:
+        lines = list(itertools.islice(
+            _wrap(f), (first - 1) * LINES, last * LINES if last else None))
+
+    # An empty file still has a (blank) first page.
+    if not lines and first != 1:
+        raise InvalidPageError(pages)
+
+    return [
+        lines[i:i + LINES] for i in range(0, max(len(lines), 1), LINES)
+    ]
+
+
+def count_pages(path):
+    "Returns the number of pages of the text file at path."
+    with open(path, 'r', encoding='utf8', errors='replace') as f:
+        # Lines are counted as they are read, the file is not held in memory.
+        lines = sum(1 for _ in _wrap(f))
+
+    # An empty file still has a (blank) first page.
+    return max(1, (lines + LINES - 1) // LINES)
+
+
+def get_font(scale):
+    try:
+        return ImageFont.truetype(FONT_PATH, max(1, round(FONT_SIZE * scale)))
+
+    except OSError:
+        LOGGER.warning('Could not load font %s, using default', FONT_PATH)
+        return ImageFont.load_default()
+
+
+def render_page(lines, scale, font):
+    "Renders a page of text, scale is pixels per point."
+    image = Image.new('RGB', (
+        max(1, round(PAGE_SIZE[0] * scale)),
+        max(1, round(PAGE_SIZE[1] * scale))), 'white')
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text(
+            (MARGIN * scale, (MARGIN + i * LINE_HEIGHT) * scale), line,
+            fill='black', font=font)
+    return image
+
+
+class TextBackend(BaseBackend):
+    name = 'text'
+    extensions = [
+        'txt', 'log', 'csv',
+    ]
+    executor = make_executor(MAX_TEXT_WORKERS)
+
+    def info(self, obj):
+        pages = count_pages(obj.src.path)
+        return {
+            'pages': pages, 'sizes': [list(PAGE_SIZE)] * pages, 'units': 'pt',
+        }
+
+    @log_duration
+    def _preview_image(self, obj):
+        pages = obj.args.get('pages')
+        # We can only convert one page to an image, choose the first.
+        page = pages[0] or 1
+        lines = read_pages(obj.src.path, (page, page))[0]
+
+        scale = min(obj.width / PAGE_SIZE[0], obj.height / PAGE_SIZE[1])
+        image = render_page(lines, scale, get_font(scale))
+        ImageDraw.Draw(image).rectangle(
+            [0, 0, image.width - 1, image.height - 1], outline=BORDER_COLOR)
+
+        # Center the page on a background of the requested size.
+        bg = Image.new('RGB', (obj.width, obj.height), 'white')
+        bg.paste(image, ((bg.width - image.width) // 2,
+                         (bg.height - image.height) // 2))
+
+        with NamedTemporaryFile(delete=False, suffix='.gif') as t:
+            bg.save(t.name, 'GIF')
+            obj.dst = PathModel(t.name)
+
+    @log_duration
+    def _preview_pdf(self, obj):
+        font = get_font(PDF_SCALE)
+        images = [
+            render_page(lines, PDF_SCALE, font)
+            for lines in read_pages(obj.src.path, obj.args.get('pages'))
+        ]
+
+        with NamedTemporaryFile(delete=False, suffix='.pdf') as t:
+            images[0].save(t.name, 'PDF', save_all=True,
+                           append_images=images[1:],
+                           resolution=72.0 * PDF_SCALE)
+            obj.dst = PathModel(t.name)
@@ -7,10 +7,11 @@ import av
 from PIL import Image
 import img2pdf
 
-from preview.backends.base import BaseBackend
+from preview.backends.base import BaseBackend, make_executor
 from preview.utils import log_duration
 from preview.models import PathModel
 from preview.errors import InvalidPageError
+from preview.config import MAX_VIDEO_WORKERS
 
 
 LOGGER = logging.getLogger(__name__)
@@ -77,6 +78,22 @@ class VideoBackend(BaseBackend):
         'webvtt', 'wmv', 'wsaud', 'wsvqa', 'wtv', 'wv', 'xa', 'xbin', 'xmv',
         'xwma', 'yop',
     ]
+    executor = make_executor(MAX_VIDEO_WORKERS)
+    # Image previews are animated, resizing would lose all but the first
+    # frame.
+    derivable = False
+
+    def info(self, obj):
+        in_ = av.open(obj.src.path)
+        try:
+            stream = in_.streams.video[0]
+            return {
+                'pages': 1, 'sizes': [[stream.width, stream.height]],
+                'units': 'px',
+            }
+
+        finally:
+            in_.close()
 
     @log_duration
     def _preview_image(self, obj):
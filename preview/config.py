@@ -65,13 +65,29 @@ def bytesize(s):
     return parse_unit(s, SIZE_UNITS)
 
 
+def endpoints(s, port):
+    "Parses a comma separated list of host[:port], port is the default port."
+    parsed = []
+    for endpoint in s.split(','):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+
+        host, _, p = endpoint.partition(':')
+        parsed.append((host, int(p) if p else port))
+
+    return parsed
+
+
 def load_plugins(views):
     """
     HTTP handlers can be specified by /the/path/to/file.py:callable.
     
     A handler should be a callable with "pattern" and "method" attributes. The
     callable should accept request and return a tuple of (path, origin). Origin
-    is a unique path or key that is used to cache the preview.
+    is a unique path or key that is used to cache the preview. Optionally, a
+    third item, the sha256 digest of the file may be returned, which is used
+    to cache the preview when PVS_STORE_CONTENT_KEYS is enabled.
     """
     plugins, paths = [], views.split(';')
     for path in paths:
@@ -124,17 +140,55 @@ UID = os.environ.get('PVS_UID')
 GID = os.environ.get('PVS_GID')
 PORT = int(os.environ.get('PVS_PORT', '3000'))
 BASE_PATH = os.environ.get('PVS_STORE')
+STORE_CONTENT_KEYS = boolean(os.environ.get('PVS_STORE_CONTENT_KEYS'))
+STORE_INDEX = os.environ.get('PVS_STORE_INDEX', ':memory:')
+STORE_DERIVE = boolean(os.environ.get('PVS_STORE_DERIVE'))
+STORE_OFFICE_PDF = boolean(os.environ.get('PVS_STORE_OFFICE_PDF'))
+OFFICE_THUMBNAILS = boolean(os.environ.get('PVS_OFFICE_THUMBNAILS'))
 SOFFICE_ADDR = os.environ.get('PVS_SOFFICE_ADDR', '127.0.0.1')
 SOFFICE_PORT = int(os.environ.get('PVS_SOFFICE_PORT', '2002'))
 SOFFICE_TIMEOUT = int(os.environ.get('PVS_SOFFICE_TIMEOUT', '12'))
 SOFFICE_RETRY = int(os.environ.get('PVS_SOFFICE_RETRY', '3'))
+SOFFICE_ENDPOINTS = endpoints(SOFFICE_ADDR, SOFFICE_PORT)
+SOFFICE_EJECT = interval(os.environ.get('PVS_SOFFICE_EJECT', '30s'))
+SOFFICE_HEDGE = int(os.environ.get('PVS_SOFFICE_HEDGE', '0'))
+SOFFICE_TIMEOUT_MAX = interval(os.environ.get('PVS_SOFFICE_TIMEOUT_MAX'))
+SOFFICE_SCRATCH = os.environ.get('PVS_SOFFICE_SCRATCH')
+SOFFICE_BREAKER = int(os.environ.get('PVS_SOFFICE_BREAKER', '0'))
+SOFFICE_BREAKER_COOLDOWN = interval(
+    os.environ.get('PVS_SOFFICE_BREAKER_COOLDOWN', '30s'))
+SOFFICE_UNO_CONNECTIONS = int(
+    os.environ.get('PVS_SOFFICE_UNO_CONNECTIONS', '0'))
+SOFFICE_WORKERS = int(os.environ.get('PVS_SOFFICE_WORKERS', '0'))
+SOFFICE_WORKER_PORT = int(os.environ.get('PVS_SOFFICE_WORKER_PORT', '2100'))
+SOFFICE_WORKER_JOBS = int(os.environ.get('PVS_SOFFICE_WORKER_JOBS', '200'))
+SOFFICE_WORKER_RSS = bytesize(os.environ.get('PVS_SOFFICE_WORKER_RSS', '1g'))
 METRICS = boolean(os.environ.get('PVS_METRICS'))
 PROFILE_PATH = os.environ.get('PVS_PROFILE_PATH')
 MAX_FILE_SIZE = int(os.environ.get('PVS_MAX_FILE_SIZE', '0'))
 MAX_PAGES = int(os.environ.get('PVS_MAX_PAGES', '0'))
+MAX_SPRITE_PAGES = int(os.environ.get('PVS_MAX_SPRITE_PAGES', '50'))
+MEMORY_STORE_SIZE = bytesize(os.environ.get('PVS_MEMORY_STORE_SIZE', None))
+MEMORY_STORE_MAX_ITEM = bytesize(
+    os.environ.get('PVS_MEMORY_STORE_MAX_ITEM', '1m'))
 CLEANUP_MAX_SIZE = bytesize(os.environ.get('PVS_CLEANUP_MAX_SIZE', None))
 CLEANUP_INTERVAL = interval(os.environ.get('PVS_CLEANUP_INTERVAL', None))
+CLEANUP_POLICY = os.environ.get('PVS_CLEANUP_POLICY', 'lru')
+CLEANUP_REBUILD_INTERVAL = interval(
+    os.environ.get('PVS_CLEANUP_REBUILD_INTERVAL', None))
+CPUS = os.cpu_count() or 1
 MAX_OFFICE_WORKERS = int(os.environ.get('PVS_MAX_OFFICE_WORKERS', 0))
+# Each backend has workers of its own by default, so that a backlog of one
+# type of file can not occupy every thread.
+MAX_IMAGE_WORKERS = int(os.environ.get('PVS_MAX_IMAGE_WORKERS', CPUS))
+MAX_PDF_WORKERS = int(os.environ.get('PVS_MAX_PDF_WORKERS', CPUS))
+MAX_VIDEO_WORKERS = int(os.environ.get('PVS_MAX_VIDEO_WORKERS', 2))
+MAX_TEXT_WORKERS = int(os.environ.get('PVS_MAX_TEXT_WORKERS', 2))
+GHOSTSCRIPT_WORKERS = int(os.environ.get('PVS_GHOSTSCRIPT_WORKERS', CPUS))
+PDF_ENGINE = os.environ.get('PVS_PDF_ENGINE', 'ghostscript').lower()
+WATCH = boolean(os.environ.get('PVS_WATCH'))
+WATCH_REGENERATE = int(os.environ.get('PVS_WATCH_REGENERATE', '0'))
+WATCH_DELAY = interval(os.environ.get('PVS_WATCH_DELAY', '1s'))
 PLUGINS = load_plugins(os.environ.get('PVS_PLUGINS', ''))
 ICON_ROOT = os.environ.get('PVS_ICONS', pathjoin(ROOT, 'images/file-types'))
 ICON_RESIZE = boolean(os.environ.get('PVS_ICON_RESIZE', 'true'))
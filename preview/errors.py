@@ -10,6 +10,15 @@ class InvalidPluginError(BaseError):
     pass
 
 
+class CircuitOpenError(BaseError):
+    pass
+
+
 class InvalidPageError(BaseError):
     def __init__(self, pages):
-        super().__init__('Invalid page range: %i-%i' % pages)
+        # pages is kept in args so that the error can be pickled.
+        super().__init__(pages)
+        self.pages = pages
+
+    def __str__(self):
+        return 'Invalid page range: %i-%i' % self.pages
@@ -79,7 +79,9 @@ def get(obj):
     obj.src = PathModel(icon_path)
 
     if ICON_RESIZE:
-        # Resize or convert the icon to the desired size / format.
+        # Resize or convert the icon to the desired size / format. The icon
+        # stands for the document, whatever pages were requested.
+        obj.args['pages'] = (1, 1)
         Backend.preview(obj)
 
     return True
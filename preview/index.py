@@ -0,0 +1,306 @@
+import os
+import sqlite3
+import logging
+import threading
+
+from time import time
+
+from os.path import join as pathjoin
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+BATCH_SIZE = 1000
+# Regeneration time assumed for files whose cost was not recorded.
+DEFAULT_COST = 1.0
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS files (
+        key TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        atime REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 1,
+        cost REAL,
+        priority REAL NOT NULL DEFAULT 0,
+        family TEXT,
+        width INTEGER,
+        height INTEGER,
+        source TEXT,
+        origin TEXT,
+        format TEXT,
+        pages TEXT,
+        watched REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS files_priority ON files (priority, atime)',
+    'CREATE INDEX IF NOT EXISTS files_family ON files (family, width)',
+    'CREATE INDEX IF NOT EXISTS files_source ON files (source)',
+]
+
+
+class LRUPolicy(object):
+    "Evicts the least recently used files first."
+    name = 'lru'
+
+    def priority(self, hits, cost, size, atime):
+        return atime
+
+    def evicted(self, priority):
+        pass
+
+
+class LFUPolicy(LRUPolicy):
+    "Evicts the least frequently used files first."
+    name = 'lfu'
+
+    def priority(self, hits, cost, size, atime):
+        # Ties are broken by atime.
+        return hits
+
+
+class GDSFPolicy(LRUPolicy):
+    """
+    Greedy-Dual-Size-Frequency, evicts files that are cheap to regenerate,
+    large and rarely used first.
+
+    The inflation value ages files that are no longer used, it is raised to
+    the priority of each evicted file.
+    """
+    name = 'gdsf'
+
+    def __init__(self):
+        self.inflation = 0
+
+    def priority(self, hits, cost, size, atime):
+        if cost is None:
+            cost = DEFAULT_COST
+        return self.inflation + hits * cost / max(size, 1)
+
+    def evicted(self, priority):
+        self.inflation = max(self.inflation, priority)
+
+
+POLICIES = {
+    policy.name: policy for policy in (LRUPolicy, LFUPolicy, GDSFPolicy)
+}
+
+
+def get_policy(name):
+    try:
+        return POLICIES[name.lower()]()
+
+    except KeyError:
+        raise ValueError('Eviction policy should be one of: %s' %
+                         ', '.join(POLICIES.keys()))
+
+
+class Index(object):
+    """
+    Tracks the files in the store.
+
+    The index is maintained as previews are stored, served and removed, so
+    that totals and eviction candidates are available without walking the
+    store.
+    """
+    def __init__(self, path=':memory:', policy=None):
+        self.path = path
+        self.policy = policy or LRUPolicy()
+        self.count = 0
+        self.size = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._db.create_function('priority', 4, self.policy.priority)
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        self._update_totals()
+
+    def __len__(self):
+        return self.count
+
+    def _update_totals(self):
+        count, size = self._db.execute(
+            'SELECT COUNT(*), SUM(size) FROM files').fetchone()
+        self.count, self.size = count, size or 0
+
+    def _get_size(self, key):
+        row = self._db.execute(
+            'SELECT size FROM files WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def add(self, key, size, atime=None, cost=None, family=None, width=None,
+            height=None, source=None, origin=None, format=None, pages=None):
+        """
+        Adds a file to the index. Cost is the time taken to generate the
+        file, it is used by cost aware eviction policies. Family identifies
+        the previews of a file that differ only by size. Source is the path
+        of the previewed file, when given, the remaining arguments allow the
+        preview to be regenerated.
+        """
+        if atime is None:
+            atime = time()
+        if pages is not None:
+            pages = '%i-%i' % pages
+
+        with self._lock:
+            old = self._get_size(key)
+            self._db.execute(
+                'INSERT OR REPLACE INTO files '
+                '(key, size, atime, hits, cost, priority, family, width, '
+                'height, source, origin, format, pages) '
+                'VALUES (?, ?, ?, 1, ?, priority(1, ?, ?, ?), ?, ?, ?, ?, ?, '
+                '?, ?)',
+                (key, size, atime, cost, cost, size, atime, family, width,
+                 height, source, origin, format, pages))
+            if old is None:
+                self.count += 1
+                self.size += size
+
+            else:
+                self.size += size - old
+
+    def touch(self, key, atime=None):
+        if atime is None:
+            atime = time()
+
+        with self._lock:
+            self._db.execute(
+                'UPDATE files SET atime = ?, hits = hits + 1, '
+                'priority = priority(hits + 1, cost, size, ?) WHERE key = ?',
+                (atime, atime, key))
+
+    def remove(self, key):
+        with self._lock:
+            old = self._get_size(key)
+            if old is None:
+                return
+
+            self._db.execute('DELETE FROM files WHERE key = ?', (key,))
+            self.count -= 1
+            self.size -= old
+
+    def watch(self, key, session, source):
+        "Records that source has been watched for changes since session."
+        with self._lock:
+            self._db.execute(
+                'UPDATE files SET watched = ?, source = ? WHERE key = ?',
+                (session, source, key))
+
+    def is_watched(self, key, session):
+        "Returns True if the source of key has been watched since session."
+        with self._lock:
+            row = self._db.execute(
+                'SELECT watched FROM files WHERE key = ?', (key,)).fetchone()
+        return row is not None and row[0] == session
+
+    def sources(self, path):
+        """
+        Returns a list of (key, source, origin, format, width, height, pages)
+        tuples for files whose source is path or is beneath path.
+        """
+        path = path.rstrip('/')
+        with self._lock:
+            # Paths beneath path sort between "path/" and "path0" ("0"
+            # follows "/"), this allows the source index to be used.
+            rows = self._db.execute(
+                'SELECT key, source, origin, format, width, height, pages '
+                'FROM files WHERE source = ? OR (source >= ? AND source < ?)',
+                (path, path + '/', path + '0')).fetchall()
+
+        return [
+            (key, source, origin, format, width, height,
+             tuple(map(int, pages.split('-'))) if pages else None)
+            for key, source, origin, format, width, height, pages in rows
+        ]
+
+    def renditions(self, family, width, height):
+        """
+        Returns a list of keys for larger previews in family with the same
+        aspect ratio, smallest first.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key FROM files WHERE family = ? AND width >= ? AND '
+                'height >= ? AND width * ? = height * ? AND width > ? '
+                'ORDER BY width', (family, width, height, height, width,
+                                   width)).fetchall()
+        return [key for key, in rows]
+
+    def candidates(self, limit=BATCH_SIZE):
+        """
+        Returns a list of (key, size, priority) tuples, in the order they
+        should be evicted.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT key, size, priority FROM files '
+                'ORDER BY priority, atime LIMIT ?', (limit,)).fetchall()
+
+    def _merge(self, rows):
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO files (key, size, atime, priority) '
+                'VALUES (?, ?, ?, priority(1, NULL, ?, ?))',
+                [(k, s, a, s, a) for k, s, a in rows])
+            # Rows that already existed keep their metadata, but the size and
+            # atime on disk are authoritative.
+            self._db.executemany(
+                'UPDATE files SET size = ?, atime = MAX(atime, ?) '
+                'WHERE key = ?', [(s, a, k) for k, s, a in rows])
+            self._db.executemany(
+                'INSERT OR IGNORE INTO seen (key) VALUES (?)',
+                [(k,) for k, _, _ in rows])
+
+    def rebuild(self, base_path, make_path):
+        """
+        Synchronize the index with the files in base_path.
+
+        This walks the whole store and is meant to be done once at startup.
+        Files added while the rebuild is running are tracked as usual.
+        """
+        start = time()
+        with self._lock:
+            self._db.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)')
+            self._db.execute('DELETE FROM seen')
+
+        rows = []
+        for dir, _, filenames in os.walk(base_path):
+            for fn in filenames:
+                path = pathjoin(dir, fn)
+                # Ignore anything that is not a stored preview (such as the
+                # index itself).
+                if path != make_path(fn):
+                    continue
+
+                try:
+                    st = os.stat(path)
+
+                except FileNotFoundError:
+                    continue
+
+                rows.append((fn, st.st_size, st.st_atime))
+                if len(rows) >= BATCH_SIZE:
+                    self._merge(rows)
+                    rows = []
+
+        if rows:
+            self._merge(rows)
+
+        with self._lock:
+            # Forget files that are gone, unless they were added during the
+            # rebuild.
+            self._db.execute(
+                'DELETE FROM files WHERE atime < ? AND key NOT IN '
+                '(SELECT key FROM seen)', (start,))
+            self._db.execute('DELETE FROM seen')
+            # The policy may have changed since the index was persisted.
+            self._db.execute(
+                'UPDATE files '
+                'SET priority = priority(hits, cost, size, atime)')
+            self._update_totals()
+
+        LOGGER.info('Index rebuilt: %i files, totaling %i bytes',
+                    self.count, self.size)
@@ -31,10 +31,21 @@ PREVIEW_SIZE_OUT = Summary(
     'pvs_preview_out_bytes', 'Size of preview image', [
         'backend', 'extension', 'format'
     ])
+PREVIEWS_COALESCED = Counter(
+    'pvs_previews_coalesced_total',
+    'Previews served by waiting on an identical in-flight preview')
+PREVIEWS_IN_FLIGHT = Gauge(
+    'pvs_previews_in_flight', 'Distinct previews being generated')
 CONVERSIONS = Summary(
     'pvs_conversion_time_secs', 'Backend conversion time', [
         'backend', 'extension', 'format',
     ])
+BACKEND_QUEUED = Gauge(
+    'pvs_backend_queued', 'Previews waiting for a backend worker', [
+        'backend'])
+BACKEND_ACTIVE = Gauge(
+    'pvs_backend_active', 'Previews being produced by a backend', [
+        'backend'])
 CONVERSION_ERRORS = Counter(
     'pvs_conversion_errors_total', 'Total errors during format conversion', [
         'backend', 'extension', 'format'])
@@ -42,6 +53,33 @@ STORAGE = Counter(
     'pvs_storage_operations_total', 'Storage operations', ['operation'])
 STORAGE_BYTES = Gauge('pvs_storage_bytes_total', 'Total bytes in store')
 STORAGE_FILES = Gauge('pvs_storage_files_total', 'Total files in store')
+MEMORY_STORE_BYTES = Gauge(
+    'pvs_memory_store_bytes_total', 'Total bytes in memory store')
+MEMORY_STORE_FILES = Gauge(
+    'pvs_memory_store_files_total', 'Total files in memory store')
+WATCHER_EVENTS = Counter(
+    'pvs_watcher_events_total', 'File changes seen by the watcher')
+WATCHER_REGENERATIONS = Counter(
+    'pvs_watcher_regenerations_total',
+    'Previews regenerated after their file changed')
+SOFFICE_IN_FLIGHT = Gauge(
+    'pvs_soffice_in_flight', 'Conversions in progress per soffice endpoint', [
+        'endpoint'])
+SOFFICE_EJECTIONS = Counter(
+    'pvs_soffice_ejections_total', 'soffice endpoints ejected after timeout', [
+        'endpoint'])
+SOFFICE_HEDGES = Counter(
+    'pvs_soffice_hedges_total',
+    'Slow conversions duplicated on another soffice endpoint')
+SOFFICE_REJECTED = Counter(
+    'pvs_soffice_rejected_total',
+    'Office conversions refused while soffice is failing')
+OFFICE_THUMBNAILS = Counter(
+    'pvs_office_thumbnails_total',
+    'Office previews served from the thumbnail embedded in the document')
+SOFFICE_RECYCLES = Counter(
+    'pvs_soffice_recycles_total', 'Restarts of managed soffice workers', [
+        'reason'])
 TRANSFER_LATENCY = Summary(
     'pvs_transfer_latency_secs', 'Uploads or downloads of files', [
     'operation'])
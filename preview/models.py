@@ -45,13 +45,36 @@ class PathModel(object):
             self.safe_remove()
 
 
+class BufferModel(PathModel):
+    "A stored preview whose contents are held in memory."
+    def __init__(self, path, data):
+        super(BufferModel, self).__init__(path)
+        self._data = data
+
+    def __repr__(self):
+        return '<BufferModel: %s>' % self.path
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    @cached_property
+    def is_temp(self):
+        return False
+
+
 class PreviewModel(object):
     def __init__(self, path, width, height, format, origin=None, name=None,
-                 args=None):
+                 args=None, digest=None):
         self._width = width
         self._height = height
         self._format = format
         self._origin = origin
+        self._digest = digest
         self._name = name or basename(origin)
         self._src = PathModel(path)
         self._dst = None
@@ -66,7 +89,13 @@ class PreviewModel(object):
 
     @property
     def content_type(self):
-        return 'application/pdf' if self.format == 'pdf' else 'image/gif'
+        if self.format == 'pdf':
+            return 'application/pdf'
+
+        elif self.format == 'sprite':
+            return 'image/png'
+
+        return 'image/gif'
 
     @property
     def origin(self):
@@ -78,6 +107,11 @@ class PreviewModel(object):
         'The name of the file from caller'
         return self._name
 
+    @property
+    def digest(self):
+        'The sha256 digest of the file received from caller.'
+        return self._digest
+
     @cached_property
     def extension(self):
         return get_extension(self._name).lower()
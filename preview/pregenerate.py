@@ -0,0 +1,176 @@
+import os
+import asyncio
+import logging
+import argparse
+
+from time import time
+from os.path import isfile, isdir
+from os.path import join as pathjoin
+
+from preview import parse_pages, limit_sprite_pages
+from preview.preview import generate
+from preview.models import PreviewModel
+from preview.storage import resolve_path
+from preview.config import (
+    BASE_PATH, DEFAULT_FORMAT, DEFAULT_WIDTH, DEFAULT_HEIGHT,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+# How often to report progress (seconds).
+REPORT_INTERVAL = 10
+
+
+def preview_spec(s):
+    "Parses a preview specification: format:WIDTHxHEIGHT[:pages]"
+    try:
+        format, size, *pages = s.split(':')
+        width, height = map(int, size.lower().split('x'))
+        pages = parse_pages(pages[0] if pages else None)
+        if format == 'sprite':
+            pages = limit_sprite_pages(pages)
+
+    except Exception:
+        raise argparse.ArgumentTypeError(
+            'Preview must be format:WIDTHxHEIGHT[:pages], ex: image:320x240:1')
+
+    return format, width, height, pages
+
+
+class Stats(object):
+    def __init__(self):
+        self.start = time()
+        self.files = 0
+        self.generated = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def __str__(self):
+        elapsed = time() - self.start
+        total = self.generated + self.skipped + self.failed
+        return (
+            '%i files, %i previews: %i generated, %i current, %i failed in '
+            '%.1fs (%.2f previews/s)' % (
+                self.files, total, self.generated, self.skipped, self.failed,
+                elapsed, total / elapsed if elapsed else 0))
+
+
+def iter_paths(paths, list_file=None):
+    """
+    Yields (path, origin) for files beneath paths and those listed in
+    list_file.
+    """
+    if list_file:
+        with open(list_file, 'r') as f:
+            paths = paths + [l.strip() for l in f if l.strip()]
+
+    for path in paths:
+        # Previews are stored by origin, as the server names files sent to
+        # /preview/.
+        path, origin = resolve_path(path)
+        if isfile(path):
+            yield path, origin
+
+        elif isdir(path):
+            for dir, _, filenames in os.walk(path):
+                for fn in sorted(filenames):
+                    yield resolve_path(pathjoin(dir, fn))
+
+        else:
+            LOGGER.warning('Ignoring invalid path %s', path)
+
+
+async def _worker(queue, stats):
+    while True:
+        args = await queue.get()
+        if args is None:
+            break
+
+        path, origin, (format, width, height, pages) = args
+        obj = PreviewModel(path, width, height, format, origin=origin,
+                           args={'pages': pages, 'store': True})
+        try:
+            if await generate(obj):
+                stats.skipped += 1
+
+            else:
+                stats.generated += 1
+
+        except Exception as e:
+            LOGGER.warning('Failed to generate %r: %s', obj, e, exc_info=True)
+            stats.failed += 1
+
+        finally:
+            obj.cleanup()
+
+
+async def _report(stats):
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        LOGGER.info('Progress: %s', stats)
+
+
+async def pregenerate(paths, previews, workers, list_file=None):
+    """
+    Generates and stores previews for files beneath paths (relative to
+    PVS_FILES). Previews which are already stored and current are skipped.
+    """
+    stats = Stats()
+    queue = asyncio.Queue(maxsize=workers * 2)
+    tasks = [
+        asyncio.ensure_future(_worker(queue, stats)) for _ in range(workers)]
+    report = asyncio.ensure_future(_report(stats))
+
+    try:
+        for path, origin in iter_paths(paths, list_file):
+            stats.files += 1
+            for preview in previews:
+                await queue.put((path, origin, preview))
+
+        for _ in tasks:
+            await queue.put(None)
+
+        await asyncio.gather(*tasks)
+
+    finally:
+        report.cancel()
+
+    return stats
+
+
+def main(argv, loop):
+    parser = argparse.ArgumentParser(
+        prog='python -m preview pregenerate',
+        description='Generate and store previews for files in PVS_FILES.')
+    parser.add_argument(
+        'paths', nargs='*', help='Files or directories relative to PVS_FILES')
+    parser.add_argument(
+        '-l', '--list', dest='list_file',
+        help='File containing paths to generate, one per line')
+    parser.add_argument(
+        '-p', '--preview', dest='previews', action='append',
+        type=preview_spec,
+        help='Preview to generate as format:WIDTHxHEIGHT[:pages], can be '
+             'given multiple times [default: %s:%sx%s:1]' % (
+                 DEFAULT_FORMAT, DEFAULT_WIDTH, DEFAULT_HEIGHT))
+    parser.add_argument(
+        '-w', '--workers', type=int, default=os.cpu_count(),
+        help='Number of previews to generate concurrently')
+    args = parser.parse_args(argv)
+
+    if BASE_PATH is None:
+        parser.error('PVS_STORE must be configured')
+
+    if not args.paths and not args.list_file:
+        parser.error('No paths or list file given')
+
+    previews = args.previews or [(
+        DEFAULT_FORMAT, int(DEFAULT_WIDTH), int(DEFAULT_HEIGHT), (1, 1))]
+
+    stats = loop.run_until_complete(pregenerate(
+        args.paths, previews, max(1, args.workers), args.list_file))
+    LOGGER.info('Done: %s', stats)
+
+    return 1 if stats.failed else 0
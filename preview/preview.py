@@ -1,21 +1,36 @@
+import json
 import logging
 import pathlib
 
+from time import time
+
 from os.path import getsize
+from tempfile import NamedTemporaryFile
 
-from preview.utils import get_extension, run_in_executor
+from preview.utils import (
+    get_extension, run_in_executor, safe_remove, SingleFlight,
+)
 from preview.backends.office import OfficeBackend
-from preview.backends.image import ImageBackend
+from preview.backends.image import ImageBackend, resize_image
 from preview.backends.video import VideoBackend
 from preview.backends.pdf import PdfBackend
-from preview.metrics import PREVIEWS, PREVIEW_SIZE_IN, PREVIEW_SIZE_OUT
-from preview.config import FILE_ROOT
+from preview.backends.text import TextBackend
+from preview.metrics import (
+    PREVIEWS, PREVIEW_SIZE_IN, PREVIEW_SIZE_OUT, PREVIEWS_COALESCED,
+    PREVIEWS_IN_FLIGHT,
+)
+from preview.config import FILE_ROOT, STORE_DERIVE
 from preview.errors import InvalidPageError
+from preview.models import PathModel
 from preview import storage, icons
 
 
 LOGGER = logging.getLogger()
 LOGGER.addHandler(logging.NullHandler())
+# Previews currently being generated, by storage key.
+IN_FLIGHT = SingleFlight()
+# Documents currently being examined by get_info(), by storage key.
+INFO_IN_FLIGHT = SingleFlight()
 
 
 class UnsupportedTypeError(Exception):
@@ -32,33 +47,159 @@ def _preview(be, obj):
             be.name, obj.extension, obj.format).observe(obj.src.size)
 
 
+async def _preview_async(be, obj):
+    PREVIEW_SIZE_IN.labels(
+        be.name, obj.extension, obj.format).observe(obj.src.size)
+
+    with PREVIEWS.labels(obj.extension, obj.format).time():
+        await be.preview_async(obj)
+        PREVIEW_SIZE_OUT.labels(
+            be.name, obj.extension, obj.format).observe(obj.src.size)
+
+
 class Backend(object):
     backends = {
         tuple(obj.extensions): obj
         for obj in [
-            OfficeBackend(), ImageBackend(), VideoBackend(), PdfBackend()]
+            OfficeBackend(), ImageBackend(), VideoBackend(), PdfBackend(),
+            TextBackend()]
     }
 
     @staticmethod
-    def preview(obj):
+    def get(extension):
         for extensions, be in Backend.backends.items():
-            if obj.extension in extensions:
-                return _preview(be, obj)
+            if extension in extensions:
+                return be
+
+        raise UnsupportedTypeError('No backend for %s', extension)
+
+    @staticmethod
+    def preview(obj):
+        return _preview(Backend.get(obj.extension), obj)
+
+    @staticmethod
+    async def preview_async(obj):
+        return await _preview_async(Backend.get(obj.extension), obj)
+
+
+def _get_rendition(obj, family):
+    "Returns the path of a larger stored preview obj can be derived from."
+    if not STORE_DERIVE or family is None or obj.format != 'image' or \
+       not Backend.get(obj.extension).derivable:
+        return
+
+    return storage.get_rendition(obj, family)
+
 
-        raise UnsupportedTypeError('No backend for %s', obj.extension)
+async def _derive(obj, path):
+    "Produces an image preview by downscaling the stored preview at path."
+    if path is None:
+        return False
+
+    # Resizing is ImageMagick work, it shares the image backend's workers.
+    obj.dst = PathModel(await run_in_executor(
+        resize_image, ImageBackend.executor)(path, obj.width, obj.height))
+    return True
 
 
 @run_in_executor
-def generate(obj):
-    store, key = storage.get(obj)
+def _lookup(obj, key):
+    store, key = storage.get(obj, key)
     # If the file was fetched from the store, it will have been loaded into
     # obj. We can return to continue with the response.
     if store:
-        return
+        return True, key, None, None
+
+    # Otherwise, we need to generate a new preview. If a larger preview of
+    # the same file is stored, it is cheaper to resize that.
+    family = storage.get_family(obj) if key else None
+    return False, key, family, _get_rendition(obj, family)
 
-    # Otherwise, we need to generate a new preview.
-    Backend.preview(obj)
+
+async def _generate(obj, key):
+    store, key, family, rendition = await _lookup(obj, key)
+    if store:
+        return True
+
+    # Backends may replace obj.src, remember the original.
+    origin, source = obj.origin, obj.src.path if obj.src.is_shared else None
+    start = time()
+    if not await _derive(obj, rendition):
+        # Each backend has its own workers, office conversions wait for
+        # soffice without occupying a thread.
+        await Backend.preview_async(obj)
 
     # If a key and preview was generated, store the preview for reuse.
     if key:
-        storage.put(key, obj)
+        await run_in_executor(storage.put)(
+            key, obj, cost=time() - start, family=family, origin=origin,
+            source=source)
+
+    return False
+
+
+async def generate(obj):
+    key = storage.get_key(obj)
+    if key is None:
+        return await _generate(obj, key)
+
+    # Identical requests share a storage key. Only one of them generates the
+    # preview, the rest wait for it and then fetch the result from the store.
+    try:
+        store, shared = await IN_FLIGHT(key, _generate, obj, key)
+
+    finally:
+        PREVIEWS_IN_FLIGHT.set(len(IN_FLIGHT))
+
+    if not shared:
+        return store
+
+    LOGGER.debug('Preview for %s was generated by another request', obj.origin)
+    PREVIEWS_COALESCED.inc()
+    return await _generate(obj, key)
+
+
+def _read_info(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _store_info(key, obj, info, cost):
+    with NamedTemporaryFile('w', delete=False, suffix='.json') as t:
+        json.dump(info, t)
+    if storage.put_intermediate(key, obj, t.name, cost=cost) == t.name:
+        # The store is full.
+        safe_remove(t.name)
+
+
+async def _get_info(obj, key):
+    if key:
+        path = await run_in_executor(storage.get_intermediate)(key, obj)
+        if path is not None:
+            return await run_in_executor(_read_info)(path)
+
+    be = Backend.get(obj.extension)
+    start = time()
+    info = {'type': be.name, 'extension': obj.extension}
+    info.update(await be.info_async(obj))
+
+    if key:
+        await run_in_executor(_store_info)(key, obj, info, time() - start)
+
+    return info
+
+
+async def get_info(obj):
+    """
+    Returns a dict describing obj's source: its type, the number of pages and
+    the size of each. The result is stored alongside previews, so documents
+    are only examined once.
+    """
+    key = storage.get_intermediate_key(obj, 'info') \
+        if storage.BASE_PATH else None
+    if key is None:
+        return await _get_info(obj, key)
+
+    # The result does not depend on obj, concurrent callers can share it.
+    info, _ = await INFO_IN_FLIGHT(key, _get_info, obj, key)
+    return info
@@ -3,19 +3,29 @@ import shutil
 import hashlib
 import logging
 import errno
+import threading
 
 from os import stat
+from collections import OrderedDict
 from time import time
 
-from os.path import isfile, dirname
+from os.path import isfile, dirname, getsize, normpath, relpath
 from os.path import join as pathjoin
 
 from preview.utils import (
     safe_remove, safe_makedirs, run_in_executor, log_duration
 )
-from preview.metrics import STORAGE, STORAGE_FILES, STORAGE_BYTES
-from preview.config import BASE_PATH, CLEANUP_MAX_SIZE, CLEANUP_INTERVAL
-from preview.models import PathModel
+from preview.metrics import (
+    STORAGE, STORAGE_FILES, STORAGE_BYTES, MEMORY_STORE_FILES,
+    MEMORY_STORE_BYTES,
+)
+from preview.config import (
+    BASE_PATH, CLEANUP_MAX_SIZE, CLEANUP_INTERVAL, MEMORY_STORE_SIZE,
+    MEMORY_STORE_MAX_ITEM, STORE_CONTENT_KEYS, STORE_INDEX, STORE_DERIVE,
+    CLEANUP_REBUILD_INTERVAL, CLEANUP_POLICY, FILE_ROOT,
+)
+from preview.models import PathModel, BufferModel
+from preview.index import Index, get_policy
 from preview.backends.image import cleanup
 
 
@@ -23,6 +33,78 @@ LOGGER = logging.getLogger(__name__)
 LOGGER.addHandler(logging.NullHandler())
 
 
+class MemoryStore(object):
+    """
+    An LRU cache of preview contents, sized in bytes.
+
+    Sits in front of the disk store so that hot previews are served without
+    touching the file system.
+    """
+    def __init__(self, max_size, max_item=None):
+        self.max_size = max_size
+        self.max_item = max_item or max_size
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def _update_metrics(self):
+        MEMORY_STORE_FILES.set(len(self._items))
+        MEMORY_STORE_BYTES.set(self.size)
+
+    def get(self, key):
+        "Returns a tuple of (data, mtime) or None."
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+
+            except KeyError:
+                return
+
+            return self._items[key]
+
+    def put(self, key, data, mtime):
+        if len(data) > self.max_item:
+            return
+
+        with self._lock:
+            self._discard(key)
+            self._items[key] = (data, mtime)
+            self.size += len(data)
+
+            # Evict least recently used items until we fit.
+            while self.size > self.max_size:
+                _, (old, _) = self._items.popitem(last=False)
+                self.size -= len(old)
+
+            self._update_metrics()
+
+    def _discard(self, key):
+        try:
+            data, _ = self._items.pop(key)
+
+        except KeyError:
+            return
+
+        self.size -= len(data)
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+            self._update_metrics()
+
+
+MEMORY = MemoryStore(MEMORY_STORE_SIZE, MEMORY_STORE_MAX_ITEM) \
+    if MEMORY_STORE_SIZE else None
+INDEX = Index(STORE_INDEX, get_policy(CLEANUP_POLICY)) \
+    if BASE_PATH else None
+# Identifies the current watcher session while the watcher is removing
+# previews whose source changes, otherwise None.
+WATCH_SESSION = None
+
+
 def make_key(*args):
     key = '|'.join([str(a) for a in args])
     return hashlib.sha256(key.encode('utf8')).hexdigest()
@@ -32,46 +114,175 @@ def make_path(key):
     return pathjoin(BASE_PATH, key[:1], key[1:2], key)
 
 
-def get(obj):
+def remove(key):
+    "Removes a stored preview."
+    safe_remove(make_path(key))
+    INDEX.remove(key)
+    if MEMORY is not None:
+        MEMORY.discard(key)
+
+
+def is_content_keyed(obj):
+    "Returns True if obj is stored by the digest of it's contents."
+    return STORE_CONTENT_KEYS and obj.digest is not None
+
+
+def is_stale(obj, mtime, key=None):
+    "Returns True if a preview stored at mtime is older than it's source."
+    if is_content_keyed(obj):
+        # The contents of the source determine the key, it can't change.
+        return False
+
+    session = WATCH_SESSION
+    if key is not None and session is not None and \
+       INDEX.is_watched(key, session):
+        # The watcher will remove the preview when it's source changes.
+        return False
+
+    stale = stat(obj.src.path).st_mtime > mtime
+    if not stale and key is not None and session is not None and \
+       obj.src.is_shared:
+        # The preview is current, from now on the watcher will remove it if
+        # it's source changes.
+        INDEX.watch(key, session, obj.src.path)
+
+    return stale
+
+
+def set_watch_session(session):
+    global WATCH_SESSION
+    WATCH_SESSION = session
+
+
+def resolve_path(path):
+    """
+    Returns a tuple of (path, origin) for a file given relative to FILE_ROOT.
+    The origin identifies the file's stored previews, it is the normalized
+    path relative to FILE_ROOT, however the file was named.
+    """
+    path = normpath(pathjoin(FILE_ROOT, path))
+    return path, relpath(path, FILE_ROOT)
+
+
+def get_origin(obj):
+    "Returns the identity of obj's source or None if it should not be stored."
     if BASE_PATH is None:
         # Storage is disabled.
         LOGGER.debug('Storage is disabled, BASE_PATH is not configured')
-        return False, None
+        return
 
     # Caller opted out of storage.
-    if obj.args['store'] is False:
+    if obj.args.get('store') is False:
         LOGGER.debug('Storage is disabled for this request')
-        return False, None
+        return
+
+    if is_content_keyed(obj):
+        # The extension selects the backend, so it is part of the identity.
+        return 'sha256:%s.%s' % (obj.digest, obj.extension)
 
     if obj.origin is None:
         LOGGER.debug('Storage is disabled, no origin')
+        return
+
+    return obj.origin
+
+
+def get_key(obj):
+    "Returns the storage key for obj, or None if it should not be stored."
+    origin = get_origin(obj)
+    if origin is None:
+        return
+
+    return make_key(
+        origin, obj.format, obj.width, obj.height, obj.args.get('pages'))
+
+
+def get_family(obj):
+    "Returns a key shared by the previews of obj that differ only by size."
+    origin = get_origin(obj)
+    if origin is None:
+        return
+
+    return make_key(origin, obj.format, obj.args.get('pages'))
+
+
+def get_rendition(obj, family):
+    """
+    Returns the path of the smallest stored preview in family that is larger
+    than obj and has the same aspect ratio, or None.
+    """
+    if not STORE_DERIVE or family is None:
+        return
+
+    for key in INDEX.renditions(family, obj.width, obj.height):
+        store_path = make_path(key)
+        try:
+            mtime = stat(store_path).st_mtime
+
+        except FileNotFoundError:
+            INDEX.remove(key)
+            continue
+
+        if not is_stale(obj, mtime, key):
+            LOGGER.debug('Found rendition of %s at %s', obj.origin, store_path)
+            return store_path
+
+
+def get(obj, key=None):
+    if key is None:
+        key = get_key(obj)
+    if key is None:
         return False, None
 
-    key = make_key(
-        obj.origin, obj.format, obj.width, obj.height, obj.args.get('pages'))
     store_path = make_path(key)
 
+    if MEMORY is not None:
+        item = MEMORY.get(key)
+        if item is not None:
+            data, mtime = item
+            if not is_stale(obj, mtime, key):
+                LOGGER.debug('Serving preview for %s from memory', obj.origin)
+                STORAGE.labels('get_memory').inc()
+                INDEX.touch(key)
+                obj.dst = BufferModel(store_path, data)
+                return True, key
+
+            MEMORY.discard(key)
+
     if not isfile(store_path):
         LOGGER.debug('Preview for %s not found at %s', obj.origin, store_path)
         return False, key
 
     mtime = stat(store_path).st_mtime
-    if stat(obj.src.path).st_mtime > mtime:
+    if is_stale(obj, mtime, key):
         LOGGER.info('Removing preview for %s at %s', obj.origin, store_path)
         STORAGE.labels('del').inc()
-        safe_remove(store_path)
+        remove(key)
         return False, key
 
     LOGGER.debug('Serving preview for %s from %s', obj.origin, store_path)
     STORAGE.labels('get').inc()
     # update atime, but leave mtime untouched.
-    os.utime(store_path, (time(), mtime))
+    atime = time()
+    os.utime(store_path, (atime, mtime))
+    INDEX.touch(key, atime)
     obj.dst = PathModel(store_path)
 
+    if MEMORY is not None and obj.dst.size <= MEMORY.max_item:
+        # Keep a copy in memory for subsequent requests.
+        with open(store_path, 'rb') as f:
+            data = f.read()
+        MEMORY.put(key, data, mtime)
+        obj.dst = BufferModel(store_path, data)
+
     return True, key
 
 
-def put(key, obj):
+def put(key, obj, cost=None, family=None, origin=None, source=None):
+    """
+    Stores the preview of obj. Origin and source are the origin and path of
+    the previewed file, obj's may have been replaced during conversion.
+    """
     STORAGE.labels('put').inc()
 
     store_path = make_path(key)
@@ -92,39 +303,104 @@ def put(key, obj):
     # changes later, this preview will be regenerated.
     src_mtime = stat(obj.src.path).st_mtime
     os.utime(store_path, (src_mtime, src_mtime))
+    INDEX.add(key, getsize(store_path), cost=cost, family=family,
+              width=obj.width, height=obj.height, source=source,
+              origin=origin, format=obj.format, pages=obj.args.get('pages'))
 
     # Update dst path, this is the preview sent in the response.
     obj.dst = PathModel(store_path)
 
 
+def get_intermediate_key(obj, kind):
+    """
+    Returns a key for an intermediate file (such as a PDF conversion) of obj's
+    source, or None if it should not be stored.
+    """
+    # Temporary files can only be identified by their contents.
+    if not is_content_keyed(obj) and not obj.src.is_shared:
+        return
+
+    origin = get_origin(obj)
+    if origin is None:
+        return
+
+    return make_key(origin, kind)
+
+
+def get_intermediate(key, obj):
+    "Returns the path of a stored intermediate file, or None."
+    store_path = make_path(key)
+
+    if not isfile(store_path):
+        return
+
+    mtime = stat(store_path).st_mtime
+    if is_stale(obj, mtime, key):
+        LOGGER.info('Removing intermediate for %s at %s', obj.origin,
+                    store_path)
+        STORAGE.labels('del').inc()
+        remove(key)
+        return
+
+    LOGGER.debug('Using intermediate for %s from %s', obj.origin, store_path)
+    STORAGE.labels('get_intermediate').inc()
+    atime = time()
+    os.utime(store_path, (atime, mtime))
+    INDEX.touch(key, atime)
+    return store_path
+
+
+def put_intermediate(key, obj, path, cost=None):
+    """
+    Stores an intermediate file. Returns the stored path, or path if it could
+    not be stored.
+    """
+    STORAGE.labels('put_intermediate').inc()
+
+    store_path = make_path(key)
+    LOGGER.debug('Storing intermediate for %s at %s', obj.origin, store_path)
+
+    try:
+        safe_makedirs(dirname(store_path))
+        shutil.move(path, store_path)
+
+    except IOError as e:
+        if e.errno != errno.ENOSPC:
+            raise
+        return path
+
+    src_mtime = stat(obj.src.path).st_mtime
+    os.utime(store_path, (src_mtime, src_mtime))
+    source = obj.src.path if obj.src.is_shared else None
+    INDEX.add(key, getsize(store_path), cost=cost, source=source)
+
+    return store_path
+
+
 class Cleanup(object):
     def __init__(self, loop, base_path=BASE_PATH,
-                 max_size=CLEANUP_MAX_SIZE, interval=CLEANUP_INTERVAL):
+                 max_size=CLEANUP_MAX_SIZE, interval=CLEANUP_INTERVAL,
+                 rebuild_interval=CLEANUP_REBUILD_INTERVAL):
         self.loop = loop
         self.base_path = base_path
         self.max_size = max_size
         self.interval = interval
+        self.rebuild_interval = rebuild_interval
         self.last = 0
+        self.last_rebuild = None
         self.loop.call_soon(run_in_executor(self.cleanup))
 
-    def scan(self):
-        # walk storage location
-        files = []
-        for dir, _, filenames in os.walk(BASE_PATH):
-            # enumerate files
-            for fn in filenames:
-                path = pathjoin(BASE_PATH, dir, fn)
-                atime = os.stat(path).st_atime
-                size = os.path.getsize(path)
-                files.append((atime, size, path))
-
-        # sort by atime desc
-        files.sort(key=lambda x: -x[0])
-
-        # determine if we are over-size
-        size = sum(x[1] for x in files)
+    def should_rebuild(self):
+        if self.base_path is None:
+            return False
 
-        return size, files
+        # Always rebuild at startup, then optionally at rebuild_interval to
+        # pick up files stored by other processes sharing the store.
+        if self.last_rebuild is None or (
+                self.rebuild_interval and
+                time() - self.last_rebuild >= self.rebuild_interval):
+            self.last_rebuild = time()
+            return True
 
     def should_remove(self):
         if self.base_path is None or self.max_size is None:
@@ -134,37 +410,48 @@ class Cleanup(object):
             self.last = time()
             return True
 
+    @log_duration
+    def rebuild(self):
+        INDEX.rebuild(self.base_path, make_path)
+
     @log_duration
     def cleanup(self):
         # Try to clean up magickwand temp files.
         cleanup()
 
         try:
-            # Get totals for metrics.
-            size, files = self.scan()
-            count = len(files)
+            if self.should_rebuild():
+                self.rebuild()
+
+            if INDEX is None:
+                return
 
+            # Get totals for metrics.
             LOGGER.info('Storage: %i files, totaling %i bytes',
-                        count, size)
-            STORAGE_FILES.set(count)
-            STORAGE_BYTES.set(size)
+                        INDEX.count, INDEX.size)
+            STORAGE_FILES.set(INDEX.count)
+            STORAGE_BYTES.set(INDEX.size)
 
             if not self.should_remove():
                 return
 
             LOGGER.debug('Performing cleanup')
 
-            # Prune files older than max_storage_age
-            ifiles = iter(files)
-            while size >= self.max_size:
-                try:
-                    atime, file_size, path = ifiles.__next__()
-
-                except StopIteration:
+            # Prune files in the order chosen by the eviction policy until
+            # under max_size.
+            while INDEX.size >= self.max_size:
+                files = INDEX.candidates()
+                if not files:
                     break
 
-                size -= file_size
-                safe_remove(path)
+                for key, file_size, priority in files:
+                    if INDEX.size < self.max_size:
+                        break
+                    remove(key)
+                    INDEX.policy.evicted(priority)
+
+            STORAGE_FILES.set(INDEX.count)
+            STORAGE_BYTES.set(INDEX.size)
 
         finally:
             self.loop.call_later(60, run_in_executor(self.cleanup))
@@ -2,7 +2,9 @@ import os
 import functools
 import asyncio
 import logging
+import threading
 
+from collections import deque
 from os.path import splitext
 from os.path import join as pathjoin
 
@@ -21,6 +23,132 @@ def run_in_executor(f, executor=None):
     return inner
 
 
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls sharing a key into a single call.
+
+    The first caller for a key runs the coroutine, later callers wait for it
+    to complete and receive the same result (or exception).
+    """
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _done(self, key, future):
+        self._calls.pop(key, None)
+        # Retrieve the exception so asyncio does not complain if no caller
+        # is left waiting for it.
+        if not future.cancelled():
+            future.exception()
+
+    async def __call__(self, key, f, *args, **kwargs):
+        """
+        Returns a tuple of (result, shared). Shared is True when the result
+        was produced by another caller.
+        """
+        future, shared = self._calls.get(key), True
+        if future is None:
+            future, shared = asyncio.ensure_future(f(*args, **kwargs)), False
+            self._calls[key] = future
+            future.add_done_callback(functools.partial(self._done, key))
+
+        # Shield the call so that a cancelled caller (client disconnect) does
+        # not cancel the work other callers are waiting for.
+        return await asyncio.shield(future), shared
+
+
+class Latencies(object):
+    "Keeps the most recent durations of an operation."
+    def __init__(self, size=100):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, duration):
+        with self._lock:
+            self._samples.append(duration)
+
+    def percentile(self, p):
+        "Returns the p-th percentile of the samples, None if there are none."
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast while an operation is failing.
+
+    The breaker opens once the error rate of the last size calls reaches
+    threshold (0-1). Calls are then refused until cooldown (seconds) has
+    passed, after which a single trial call is allowed. A success closes the
+    breaker, a failure opens it again.
+    """
+    TRIAL = 'trial'
+    NORMAL = 'normal'
+
+    def __init__(self, threshold, cooldown, size=20):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._results = deque(maxlen=size)
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+    def allow(self):
+        """
+        Returns a token (TRIAL or NORMAL) if a call should be made, otherwise
+        None. The token is passed to record().
+        """
+        with self._lock:
+            if self._opened is None:
+                return self.NORMAL
+
+            if self._trial or time() - self._opened < self.cooldown:
+                return
+
+            self._trial = True
+            return self.TRIAL
+
+    def record(self, token, success):
+        """
+        Records the result of a call, every allowed call must be recorded
+        with the token returned by allow().
+        """
+        with self._lock:
+            if self._opened is not None:
+                # Calls allowed before the breaker opened may finish while
+                # it is open, only the trial decides whether to close it.
+                if token != self.TRIAL:
+                    return
+
+                if success:
+                    self._opened = None
+                    self._results.clear()
+
+                else:
+                    self._opened = time()
+
+                self._trial = False
+                return
+
+            self._results.append(success)
+            errors = self._results.count(False)
+            if len(self._results) == self._results.maxlen and \
+               errors >= self.threshold * len(self._results):
+                self._opened = time()
+
+
 def quote(obj):
     if type(obj) is str:
         return '"%s"' % obj
@@ -47,7 +175,32 @@ def fstr(f, args, kwargs=None):
     return '%s(%s)' % (fname, astr)
 
 
+def _log_duration(f, args, kwargs, start):
+    duration = time() - start
+
+    if duration <= 5:
+        level = logging.DEBUG
+    elif duration <= 10:
+        level = logging.INFO
+    else:
+        level = logging.WARNING
+
+    LOGGER.log(level, '%s took %fs', fstr(f, args, kwargs), duration)
+
+
 def log_duration(f):
+    if asyncio.iscoroutinefunction(f):
+        @functools.wraps(f)
+        async def inner(*args, **kwargs):
+            start = time()
+            try:
+                return await f(*args, **kwargs)
+
+            finally:
+                _log_duration(f, args, kwargs, start)
+
+        return inner
+
     @functools.wraps(f)
     def inner(*args, **kwargs):
         start = time()
@@ -55,17 +208,7 @@ def log_duration(f):
             return f(*args, **kwargs)
 
         finally:
-            duration = time() - start
-
-            if duration <= 5:
-                level = logging.DEBUG
-            elif duration <= 10:
-                level = logging.INFO
-            else:
-                level = logging.WARNING
-
-            LOGGER.log(
-                level, '%s took %fs', fstr(f, args, kwargs), duration)
+            _log_duration(f, args, kwargs, start)
 
     return inner
 
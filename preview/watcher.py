@@ -0,0 +1,167 @@
+import asyncio
+import logging
+
+from time import time
+
+from preview import storage
+from preview.preview import generate
+from preview.utils import run_in_executor
+from preview.models import PreviewModel
+from preview.metrics import WATCHER_EVENTS, WATCHER_REGENERATIONS
+from preview.config import FILE_ROOT, WATCH_REGENERATE, WATCH_DELAY
+
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
+
+EVENTS = 'close_write,moved_to,moved_from,delete'
+# Events after which the file no longer exists.
+REMOVED = ('MOVED_FROM', 'DELETE')
+# Wait before restarting inotifywait if it exits.
+RESTART_DELAY = 10
+
+
+class Watcher(object):
+    """
+    Watches FILE_ROOT for changes using inotifywait (inotify-tools).
+
+    Stored previews of files that change are removed, and optionally
+    regenerated in the background. While the watcher is running, previews
+    are not checked against the mtime of their source when served.
+    """
+    def __init__(self, loop, root=FILE_ROOT, regenerate=WATCH_REGENERATE,
+                 delay=WATCH_DELAY):
+        self.loop = loop
+        self.root = root
+        self.delay = delay
+        self.pending = {}
+        self.regenerate = asyncio.Semaphore(regenerate) if regenerate \
+            else None
+        self.loop.call_soon(asyncio.ensure_future, self.watch())
+
+    async def _established(self, stream):
+        # inotifywait reports on stderr once all watches are in place.
+        while True:
+            line = await stream.readline()
+            if not line:
+                return False
+            line = line.decode('utf8', 'replace').strip()
+            if line == 'Watches established.':
+                return True
+            LOGGER.info('inotifywait: %s', line)
+
+    async def _log(self, stream):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            LOGGER.warning(
+                'inotifywait: %s', line.decode('utf8', 'replace').strip())
+
+    async def watch(self):
+        while True:
+            try:
+                await self._watch()
+
+            except FileNotFoundError:
+                LOGGER.error('inotifywait is not installed, not watching %s',
+                             self.root)
+                return
+
+            except Exception as e:
+                LOGGER.exception(e)
+
+            finally:
+                storage.set_watch_session(None)
+
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def _watch(self):
+        p = await asyncio.create_subprocess_exec(
+            'inotifywait', '--monitor', '--recursive', '--event', EVENTS,
+            '--format', '%e %w%f', self.root,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+        try:
+            if not await self._established(p.stderr):
+                return
+
+            LOGGER.info('Watching %s for changes', self.root)
+            # Previews are only trusted once checked during this session.
+            storage.set_watch_session(time())
+            asyncio.ensure_future(self._log(p.stderr))
+
+            while True:
+                line = await p.stdout.readline()
+                if not line:
+                    break
+                self.handle(line)
+
+        finally:
+            if p.returncode is None:
+                p.kill()
+            LOGGER.warning('inotifywait exited: %s', await p.wait())
+
+    def handle(self, line):
+        "Handles a line of inotifywait output, formatted as '%e %w%f'."
+        events, _, path = line.decode('utf8', 'replace') \
+            .rstrip('\n').partition(' ')
+        events = events.split(',')
+        if 'Q_OVERFLOW' in events:
+            # Events were lost, previews must be checked again.
+            LOGGER.warning('inotify queue overflow')
+            storage.set_watch_session(time())
+            return
+
+        WATCHER_EVENTS.inc()
+        self.changed(path, removed=any(e in REMOVED for e in events))
+
+    def changed(self, path, removed=False):
+        # Changes are batched, a file is often written more than once.
+        if not self.pending:
+            self.loop.call_later(self.delay, asyncio.ensure_future,
+                                 self.process())
+        self.pending[path] = removed
+
+    @run_in_executor
+    def invalidate(self, pending):
+        "Removes stored previews, returns those to regenerate."
+        regenerate = []
+        for path, removed in pending.items():
+            for key, source, origin, format, width, height, pages in \
+                    storage.INDEX.sources(path):
+                LOGGER.debug('Removing preview of changed file %s', source)
+                storage.remove(key)
+
+                # Intermediate files have no format, they are generated as
+                # needed.
+                if not removed and format is not None:
+                    regenerate.append(
+                        (source, origin, format, width, height, pages))
+
+        return regenerate
+
+    async def process(self):
+        pending, self.pending = self.pending, {}
+        regenerate = await self.invalidate(pending)
+
+        if self.regenerate is None:
+            return
+
+        for args in regenerate:
+            asyncio.ensure_future(self._regenerate(*args))
+
+    async def _regenerate(self, path, origin, format, width, height, pages):
+        obj = PreviewModel(path, width, height, format, origin=origin,
+                           args={'pages': pages, 'store': True})
+        async with self.regenerate:
+            try:
+                await generate(obj)
+                WATCHER_REGENERATIONS.inc()
+
+            except Exception as e:
+                LOGGER.warning('Failed to regenerate %r: %s', obj, e,
+                               exc_info=True)
+
+            finally:
+                obj.cleanup()
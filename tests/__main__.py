@@ -16,10 +16,23 @@ os.environ['PROXY_UPSTREAM'] = 'http://api/'
 os.environ['PROXY_BASE_PATH'] = '/files/:%s' % ROOT
 
 
+# Ghostscript runs in worker processes, as it does in the server.
+from preview.backends import raster
+from preview.config import GHOSTSCRIPT_WORKERS
+raster.start(GHOSTSCRIPT_WORKERS)
+
+
 from tests.test_preview import *
 from tests.test_plugins import *
 from tests.test_icons import *
 from tests.test_config import *
+from tests.test_utils import *
+from tests.test_index import *
+from tests.test_storage import *
+from tests.test_pdf import *
+from tests.test_office import *
+from tests.test_pregenerate import *
+from tests.test_watcher import *
 
 
 unittest.main()
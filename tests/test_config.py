@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from preview.config import boolean, interval, bytesize
+from preview.config import boolean, interval, bytesize, endpoints
 
 
 class BooleanTestCase(TestCase):
@@ -49,3 +49,13 @@ class BytesizeTestCase(TestCase):
         self.assertEqual(bytesize('5g'), 5368709120)
         self.assertEqual(bytesize('5G'), 5368709120)
         self.assertEqual(bytesize('1t'), 1099511627776)
+
+
+class EndpointsTestCase(TestCase):
+    def test_parse_single(self):
+        self.assertEqual(endpoints('127.0.0.1', 2002), [('127.0.0.1', 2002)])
+
+    def test_parse_list(self):
+        self.assertEqual(
+            endpoints('soffice-1:2003, soffice-2,', 2002),
+            [('soffice-1', 2003), ('soffice-2', 2002)])
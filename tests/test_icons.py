@@ -29,3 +29,14 @@ class PreviewIconTestCase(PreviewTestCase):
         # (file type icon).
         self.assertEqual(r.status, 200)
         self.assertEqual(r.headers['content-type'], 'image/gif')
+
+    @unittest_run_loop
+    async def test_exe_sprite(self):
+        "Ensure the icon is returned for a sprite of later pages."
+        r = await self.client.request(
+            'GET', '/preview/',
+            params={'format': 'sprite', 'pages': '3-4',
+                    'path': FIXTURE_W64_EXE}
+        )
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.headers['content-type'], 'image/png')
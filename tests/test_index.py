@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+from preview.index import Index, get_policy
+
+
+class IndexTestCase(TestCase):
+    def test_totals(self):
+        index = Index()
+        index.add('a', 10)
+        index.add('b', 20)
+        self.assertEqual((index.count, index.size), (2, 30))
+        # Replacing a file should adjust the size.
+        index.add('a', 5)
+        self.assertEqual((index.count, index.size), (2, 25))
+        index.remove('b')
+        index.remove('missing')
+        self.assertEqual((index.count, index.size), (1, 5))
+
+
+    def test_renditions(self):
+        index = Index()
+        index.add('800x600', 10, family='f', width=800, height=600)
+        index.add('640x480', 10, family='f', width=640, height=480)
+        index.add('320x240', 10, family='f', width=320, height=240)
+        index.add('800x800', 10, family='f', width=800, height=800)
+        index.add('other', 10, family='g', width=800, height=600)
+        # Larger previews with the same aspect ratio, smallest first.
+        self.assertEqual(
+            index.renditions('f', 320, 240), ['640x480', '800x600'])
+        self.assertEqual(index.renditions('f', 800, 600), [])
+
+
+class PolicyTestCase(TestCase):
+    def make_index(self, name):
+        index = Index(policy=get_policy(name))
+        index.add('large-cheap', 1000000, atime=1, cost=0.1)
+        index.add('small-expensive', 1000, atime=2, cost=5)
+        index.add('small-cheap', 1000, atime=3, cost=0.05)
+        index.touch('large-cheap', atime=4)
+        index.touch('large-cheap', atime=5)
+        return index
+
+    def evicted(self, index):
+        return [key for key, _, _ in index.candidates()]
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            get_policy('foobar')
+
+    def test_lru(self):
+        self.assertEqual(
+            self.evicted(self.make_index('lru')),
+            ['small-expensive', 'small-cheap', 'large-cheap'])
+
+    def test_lfu(self):
+        self.assertEqual(
+            self.evicted(self.make_index('lfu')),
+            ['small-expensive', 'small-cheap', 'large-cheap'])
+
+    def test_gdsf(self):
+        self.assertEqual(
+            self.evicted(self.make_index('gdsf')),
+            ['large-cheap', 'small-cheap', 'small-expensive'])
@@ -0,0 +1,427 @@
+import os
+import sys
+import shutil
+import asyncio
+import zipfile
+import subprocess
+
+from io import BytesIO
+from time import sleep, time
+from collections import defaultdict
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+from tempfile import mkdtemp
+
+from os.path import join as pathjoin, dirname
+
+from PIL import Image
+
+from preview.backends import office
+from preview.models import PathModel, PreviewModel
+from preview.utils import Latencies, safe_remove
+
+
+ROOT = dirname(dirname(__file__))
+FIXTURE_SAMPLE_DOC = pathjoin(ROOT, 'fixtures/sample.doc')
+# Stands in for unoconv. Each port is a soffice server that takes delay
+# seconds, then writes the PDF or fails with returncode. The pid of each
+# conversion is written to the pids directory.
+FAKE_UNOCONV = '''#!%s
+import os, sys, time
+
+ENDPOINTS = %r
+args = dict(a[2:].split('=', 1) for a in sys.argv if a.startswith('--') and
+            '=' in a)
+if '--stdin' in sys.argv:
+    sys.stdin.buffer.read()
+
+port = int(args['port'])
+with open(os.path.join(%r, str(port)), 'w') as f:
+    f.write(str(os.getpid()))
+
+delay, returncode = ENDPOINTS[port]
+time.sleep(delay)
+if returncode:
+    sys.exit(returncode)
+
+with open(args['output'], 'wb') as f:
+    f.write(b'%%PDF-' + bytes(str(port), 'ascii'))
+'''
+
+
+def _run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+@patch.object(office, 'STORE_OFFICE_PDF', True)
+@patch('preview.storage.get_intermediate_key', lambda obj, kind: 'key')
+@patch('preview.storage.get_intermediate', lambda key, obj: None)
+@patch('preview.storage.put_intermediate',
+       lambda key, obj, path, cost=None: '/store/%s' % key)
+class ConvertDocumentTestCase(TestCase):
+    def test_coalesce(self):
+        "Ensure concurrent requests share one conversion."
+        calls = []
+
+        async def convert(obj, pages=(1, 1)):
+            calls.append(pages)
+            await asyncio.sleep(0.1)
+            return '/tmp/converted.pdf'
+
+        async def run():
+            return await asyncio.gather(*[
+                office.convert_document(None) for i in range(3)])
+
+        with patch.object(office, 'convert', convert):
+            paths = _run(run())
+
+        self.assertEqual(calls, [(0, 0)])
+        self.assertEqual(paths, ['/store/key'] * 3)
+
+    def test_fallback(self):
+        "Ensure a failed full conversion lets callers convert pages."
+        async def convert(obj, pages=(1, 1)):
+            raise asyncio.TimeoutError()
+
+        with patch.object(office, 'convert', convert):
+            self.assertIsNone(_run(office.convert_document(None)))
+
+            with self.assertRaises(asyncio.TimeoutError):
+                _run(office.get_document(None))
+
+
+@patch.object(office, 'SOFFICE_TIMEOUT', 10)
+@patch.object(office, 'SOFFICE_TIMEOUT_MAX', 1000)
+@patch.object(office, 'DURATIONS', defaultdict(Latencies))
+class TimeoutTestCase(TestCase):
+    def test_whole(self):
+        "Ensure whole document conversions do not lengthen page timeouts."
+        for i in range(office.TIMEOUT_MIN_SAMPLES):
+            office.DURATIONS['doc', True].add(100)
+
+        self.assertEqual(office.get_timeout('doc', 0, True), 200)
+        self.assertEqual(office.get_timeout('doc', 0), 10)
+
+
+class HedgeTestCase(TestCase):
+    def setUp(self):
+        self.bin, self.pids, self.scratch = mkdtemp(), mkdtemp(), mkdtemp()
+
+    def tearDown(self):
+        for path in (self.bin, self.pids, self.scratch):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _hedge(self, endpoints):
+        "Converts a document using endpoints {port: (delay, returncode)}."
+        path = pathjoin(self.bin, 'unoconv')
+        with open(path, 'w') as f:
+            f.write(FAKE_UNOCONV % (sys.executable, endpoints, self.pids))
+        os.chmod(path, 0o755)
+
+        class Obj(object):
+            src = PathModel(FIXTURE_SAMPLE_DOC)
+
+        router = office.Router([
+            office.Endpoint('127.0.0.1', port) for port in sorted(endpoints)])
+        env = {'PATH': '%s:%s' % (self.bin, os.environ['PATH'])}
+        with patch.dict(os.environ, env), \
+                patch.object(office, 'ROUTER', router), \
+                patch.object(office, 'SCRATCH', self.scratch), \
+                patch.object(office, 'get_hedge_delay',
+                             lambda whole=False: 0.5):
+            try:
+                return _run(office._hedge(Obj(), 0, (1, 1)))
+
+            finally:
+                # Let the losing attempt clean up after cancellation.
+                _run(asyncio.sleep(0.5))
+
+    def _pids(self):
+        pids = {}
+        for port in os.listdir(self.pids):
+            with open(pathjoin(self.pids, port)) as f:
+                pids[int(port)] = int(f.read())
+        return pids
+
+    def _assertPDF(self, path, port):
+        try:
+            with open(path, 'rb') as f:
+                self.assertEqual(
+                    f.read(), b'%PDF-' + bytes(str(port), 'ascii'))
+
+        finally:
+            safe_remove(path)
+
+    def test_first(self):
+        "Ensure a conversion faster than the hedge delay is not hedged."
+        path = self._hedge({2001: (0, 0), 2002: (0, 0)})
+        self._assertPDF(path, 2001)
+        self.assertEqual(list(self._pids()), [2001])
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_hedge(self):
+        "Ensure the hedge wins, and the slow conversion is killed."
+        path = self._hedge({2001: (30, 0), 2002: (0, 0)})
+        self._assertPDF(path, 2002)
+
+        pids = self._pids()
+        self.assertEqual(sorted(pids), [2001, 2002])
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pids[2001], 0)
+        # The PDF the slow conversion would have written is removed.
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_both_fail(self):
+        "Ensure the first attempt's error is raised when both fail."
+        # The first attempt fails at 1s, the hedge after it at 1.5s.
+        with self.assertRaises(subprocess.CalledProcessError) as e:
+            self._hedge({2001: (1, 3), 2002: (1, 4)})
+
+        self.assertEqual(e.exception.returncode, 3)
+        self.assertEqual(sorted(self._pids()), [2001, 2002])
+        self.assertEqual(os.listdir(self.scratch), [])
+
+
+class FakePool(object):
+    "Stands in for a UNO connection pool with a single connection."
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.calls = []
+
+    def convert(self, path, data, import_filter, pages, timeout, output):
+        self.calls.append(output)
+        sleep(0.2)
+        return output
+
+
+class TimeoutPool(FakePool):
+    "Stands in for a UNO connection pool whose soffice does not respond."
+    def convert(self, path, data, import_filter, pages, timeout, output):
+        self.calls.append(output)
+        raise futures.TimeoutError()
+
+
+class WritePool(FakePool):
+    "Stands in for a UNO connection pool that converts immediately."
+    def convert(self, path, data, import_filter, pages, timeout, output):
+        self.calls.append(output)
+        with open(output, 'wb') as f:
+            f.write(b'%PDF-')
+        return output
+
+
+class UnoTestCase(TestCase):
+    def test_queued(self):
+        "Ensure conversions wait for the pool, and cancelled ones are dropped."
+        pool = FakePool()
+        endpoint = office.Endpoint('127.0.0.1', 2001, pool)
+
+        async def run():
+            first, second = [
+                asyncio.ensure_future(office._uno(
+                    endpoint, 'sample.doc', None, None, (1, 1), 10, output))
+                for output in ('first.pdf', 'second.pdf')]
+            await asyncio.sleep(0.1)
+            second.cancel()
+            return await first
+
+        self.assertEqual(_run(run()), 'first.pdf')
+        pool.executor.shutdown(wait=True)
+        # The second conversion was waiting for the pool's only thread.
+        self.assertEqual(pool.calls, ['first.pdf'])
+
+
+class RouterTestCase(TestCase):
+    def setUp(self):
+        self.endpoints = [
+            office.Endpoint('127.0.0.1', port) for port in (2001, 2002, 2003)]
+        self.router = office.Router(self.endpoints, eject=60)
+
+    def test_least_outstanding(self):
+        "Ensure conversions go to the endpoint with the fewest in flight."
+        first, second, third = self.endpoints
+        first.in_flight, second.in_flight, third.in_flight = 2, 0, 1
+
+        self.assertIs(self.router.acquire(), second)
+        # Ties go to the endpoint used least recently.
+        self.assertIs(self.router.acquire(), third)
+        self.assertIs(self.router.acquire(), second)
+        self.assertEqual([e.in_flight for e in self.endpoints], [2, 2, 2])
+
+        self.router.release(third)
+        self.assertEqual(third.in_flight, 1)
+        self.assertIs(self.router.acquire(), third)
+
+    def test_eject(self):
+        "Ensure ejected endpoints are avoided until no other is available."
+        first, second, third = self.endpoints
+        self.router.eject(first)
+        self.assertGreater(first.ejected, time())
+
+        self.assertIs(self.router.acquire(), second)
+        self.assertIs(self.router.acquire(), third)
+
+        self.router.eject(second)
+        self.router.eject(third)
+        # Every endpoint is ejected, the least busy is used anyway.
+        self.assertIs(self.router.acquire(), first)
+
+        # Once the ejection expires, the endpoint is used again.
+        second.ejected = third.ejected = time() - 1
+        self.assertIs(self.router.acquire(), second)
+
+    def test_exclude(self):
+        "Ensure retries prefer endpoints that were not tried."
+        first, second, third = self.endpoints
+        self.assertIs(self.router.acquire(exclude=[first]), second)
+        self.assertIs(self.router.acquire(exclude=[first, second]), third)
+        # Every endpoint was tried, the least busy is used again.
+        self.assertIs(
+            self.router.acquire(exclude=self.endpoints), first)
+
+
+class RetryTestCase(TestCase):
+    def setUp(self):
+        self.scratch = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def _attempt(self, endpoints, retry):
+        router = office.Router(endpoints, eject=60)
+        tried = []
+        with patch.object(office, 'ROUTER', router), \
+                patch.object(office, 'SCRATCH', self.scratch):
+            try:
+                return _run(office._attempt(
+                    'doc', FIXTURE_SAMPLE_DOC, None, None, 0, 10, retry,
+                    (1, 1), tried)), tried
+
+            finally:
+                for endpoint in endpoints:
+                    endpoint.pool.executor.shutdown(wait=True)
+                    self.assertEqual(endpoint.in_flight, 0)
+
+    def test_retry(self):
+        "Ensure a timed out conversion is ejected and retried elsewhere."
+        slow, fast = [
+            office.Endpoint('127.0.0.1', 2001, TimeoutPool()),
+            office.Endpoint('127.0.0.1', 2002, WritePool()),
+        ]
+        path, tried = self._attempt([slow, fast], 1)
+        try:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'%PDF-')
+
+        finally:
+            safe_remove(path)
+
+        self.assertEqual(tried, [slow, fast])
+        self.assertEqual(len(slow.pool.calls), 1)
+        self.assertEqual(len(fast.pool.calls), 1)
+        self.assertGreater(slow.ejected, time())
+        self.assertEqual(fast.ejected, 0)
+        # The scratch file of the failed attempt is removed.
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_no_retry(self):
+        "Ensure the error is raised once retries are exhausted."
+        slow, fast = [
+            office.Endpoint('127.0.0.1', 2001, TimeoutPool()),
+            office.Endpoint('127.0.0.1', 2002, WritePool()),
+        ]
+        with self.assertRaises(futures.TimeoutError):
+            self._attempt([slow, fast], 0)
+
+        self.assertEqual(fast.pool.calls, [])
+        self.assertGreater(slow.ejected, time())
+        self.assertEqual(os.listdir(self.scratch), [])
+
+
+class FallbackError(Exception):
+    pass
+
+
+@patch.object(office, 'OFFICE_THUMBNAILS', True)
+class ThumbnailTestCase(TestCase):
+    def setUp(self):
+        self.root = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _document(self, filename, name, size):
+        "Creates a document with an embedded thumbnail of size."
+        data = BytesIO()
+        Image.new('RGB', size).save(data, 'png')
+        path = pathjoin(self.root, filename)
+        with zipfile.ZipFile(path, 'w') as z:
+            z.writestr('content.xml', '<document/>')
+            z.writestr(name, data.getvalue())
+
+        return PreviewModel(path, 320, 240, 'image', origin=filename,
+                            args={'pages': (1, 1)})
+
+    def _assertThumbnail(self, obj, suffix, size):
+        path = office.extract_thumbnail(obj)
+        try:
+            self.assertTrue(path.endswith(suffix))
+            with Image.open(path) as image:
+                self.assertEqual(image.size, size)
+
+        finally:
+            safe_remove(path)
+
+    def test_ooxml(self):
+        obj = self._document(
+            'sample.docx', 'docProps/thumbnail.png', (400, 300))
+        self._assertThumbnail(obj, '.png', (400, 300))
+
+    def test_odf(self):
+        obj = self._document(
+            'sample.odt', 'Thumbnails/thumbnail.png', (240, 320))
+        # Either dimension may be large enough, the thumbnail is scaled down.
+        self._assertThumbnail(obj, '.png', (240, 320))
+
+    def test_missing(self):
+        obj = self._document('sample.docx', 'docProps/other.png', (400, 300))
+        self.assertIsNone(office.extract_thumbnail(obj))
+
+        with open(obj.src.path, 'wb') as f:
+            f.write(b'Not a zip file')
+        self.assertIsNone(office.extract_thumbnail(obj))
+
+    def test_too_small(self):
+        "Ensure small thumbnails fall back to converting with soffice."
+        obj = self._document(
+            'sample.docx', 'docProps/thumbnail.png', (160, 120))
+        self.assertIsNone(office.extract_thumbnail(obj))
+
+        async def convert_document(obj):
+            raise FallbackError()
+
+        with patch.object(office, 'convert_document', convert_document):
+            with self.assertRaises(FallbackError):
+                _run(office.OfficeBackend()._preview_image(obj))
+
+        self.assertIsNone(obj.dst)
+
+    def test_served(self):
+        "Ensure a large enough thumbnail is served without soffice."
+        obj = self._document(
+            'sample.docx', 'docProps/thumbnail.png', (400, 300))
+
+        async def convert_document(obj):
+            raise FallbackError()
+
+        with patch.object(office, 'convert_document', convert_document):
+            _run(office.OfficeBackend()._preview_image(obj))
+
+        try:
+            self.assertIsNotNone(obj.dst)
+            self.assertNotEqual(obj.dst.path, obj.src.path)
+
+        finally:
+            obj.cleanup()
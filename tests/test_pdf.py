@@ -0,0 +1,149 @@
+import pickle
+import shutil
+
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+from tempfile import NamedTemporaryFile
+
+from PIL import Image
+
+from os.path import join as pathjoin, dirname
+
+from preview.backends import raster
+from preview.backends.raster import run_ghostscript, RenderError
+from preview.backends.pdf import (
+    _render, _to_gif, _get_page_sizes, get_page_sizes, is_pdf,
+)
+from preview.utils import safe_remove
+from preview.errors import InvalidPageError
+
+
+ROOT = dirname(dirname(__file__))
+FIXTURE_SAMPLE_PDF = pathjoin(ROOT, 'fixtures/sample.pdf')
+
+
+def _args(path):
+    return [
+        b'-dNOPAUSE', b'-dBATCH', b'-dSAFER', b'-sDEVICE=nullpage',
+        b'-dFirstPage=1', b'-dLastPage=1', bytes(path, 'utf8'),
+    ]
+
+
+class GhostscriptPoolTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The pool is started by the server (or tests/__main__.py).
+        if not raster.WORKERS:
+            raster.start(1)
+
+    def test_error(self):
+        "Ensure a failing job is reported and the pool survives it."
+        with self.assertRaises(RenderError):
+            run_ghostscript(_args('/nonexistent.pdf'))
+
+        run_ghostscript(_args(FIXTURE_SAMPLE_PDF))
+
+    def test_pickle_invalid_page(self):
+        e = pickle.loads(pickle.dumps(InvalidPageError((2, 3))))
+        self.assertEqual(e.pages, (2, 3))
+        self.assertEqual(str(e), 'Invalid page range: 2-3')
+
+
+class EngineTestCase(TestCase):
+    def _test_page_oob(self, engine):
+        "Ensure an invalid page is reported and the pool survives it."
+        with NamedTemporaryFile(suffix='.png') as t:
+            with self.assertRaises(InvalidPageError):
+                _render(engine, FIXTURE_SAMPLE_PDF, 99, 320, 240, t.name)
+
+            self.assertTrue(
+                _render(engine, FIXTURE_SAMPLE_PDF, 1, 320, 240, t.name))
+
+    def test_ghostscript_page_oob(self):
+        self._test_page_oob('ghostscript')
+
+    def test_ghostscript_one_page(self):
+        "Ensure rendering a page does not read the size of every page."
+        def page_sizes(path):
+            self.fail('Every page was read')
+
+        with patch.object(raster, 'page_sizes', page_sizes), \
+                NamedTemporaryFile(suffix='.png') as t:
+            self.assertTrue(
+                _render('ghostscript', FIXTURE_SAMPLE_PDF, 1, 320, 240,
+                        t.name))
+
+    @skipUnless(raster.mupdf_available(), 'PyMuPDF is not installed')
+    def test_mupdf_page_oob(self):
+        self._test_page_oob('mupdf')
+
+
+class PageSizeTestCase(TestCase):
+    def test_parse_box(self):
+        self.assertEqual(raster.parse_box([b'612', b'792', b'0']),
+                         (612.0, 792.0))
+        # Rotated pages are displayed sideways.
+        self.assertEqual(raster.parse_box([b'612', b'792', b'90']),
+                         (792.0, 612.0))
+        self.assertEqual(raster.parse_box([b'612', b'792', b'-270']),
+                         (792.0, 612.0))
+        self.assertEqual(raster.parse_box([b'612', b'792', b'180']),
+                         (612.0, 792.0))
+
+    def test_fit(self):
+        self.assertEqual(raster.fit((612, 792), 320, 240), (185, 240))
+        self.assertEqual(raster.fit((792, 612), 320, 240), (310, 240))
+        self.assertEqual(raster.fit((1000, 10), 320, 240), (320, 3))
+        # Extreme aspect ratios keep at least a pixel.
+        self.assertEqual(raster.fit((100000, 1), 320, 240), (320, 1))
+
+    def test_page_sizes(self):
+        sizes = get_page_sizes(FIXTURE_SAMPLE_PDF)
+        self.assertTrue(sizes)
+        for width, height in sizes:
+            self.assertGreater(width, 0)
+            self.assertGreater(height, 0)
+
+        # The sizes are cached.
+        hits = _get_page_sizes.cache_info().hits
+        self.assertEqual(get_page_sizes(FIXTURE_SAMPLE_PDF), sizes)
+        self.assertEqual(_get_page_sizes.cache_info().hits, hits + 1)
+
+    def test_page_sizes_invalid(self):
+        with NamedTemporaryFile(suffix='.pdf') as t:
+            t.write(b'Not a PDF')
+            t.flush()
+            with self.assertRaises(RenderError):
+                get_page_sizes(t.name)
+
+    def test_is_pdf(self):
+        # Office documents are stored without an extension.
+        with NamedTemporaryFile() as t:
+            shutil.copyfile(FIXTURE_SAMPLE_PDF, t.name)
+            self.assertTrue(is_pdf(t.name))
+
+        with NamedTemporaryFile(suffix='.pdf') as t:
+            t.write(b'Not a PDF')
+            t.flush()
+            self.assertFalse(is_pdf(t.name))
+
+
+class ToGifTestCase(TestCase):
+    def test_to_gif(self):
+        with NamedTemporaryFile(suffix='.png') as t:
+            Image.new('RGB', (185, 240), 'red').save(t.name, 'PNG')
+            path = _to_gif(t.name, 320, 240)
+
+        try:
+            with Image.open(path) as image:
+                self.assertEqual(image.format, 'GIF')
+                self.assertEqual(image.size, (320, 240))
+                image = image.convert('RGB')
+                # The page is centered on a white background.
+                self.assertEqual(image.getpixel((160, 120)), (255, 0, 0))
+                self.assertEqual(image.getpixel((0, 120)), (255, 255, 255))
+                self.assertEqual(image.getpixel((319, 120)),
+                                 (255, 255, 255))
+
+        finally:
+            safe_remove(path)
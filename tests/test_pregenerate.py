@@ -0,0 +1,78 @@
+import os
+import shutil
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import patch
+from tempfile import mkdtemp, NamedTemporaryFile
+
+from os.path import join as pathjoin
+
+from preview import storage
+from preview.index import Index
+from preview.storage import resolve_path
+from preview.pregenerate import iter_paths, pregenerate, preview_spec
+
+
+class PregenerateTestCase(TestCase):
+    def setUp(self):
+        self.root, self.base_path = mkdtemp(), mkdtemp()
+        for path in ('a/b.txt', 'a/c/d.txt', 'e.txt'):
+            path = pathjoin(self.root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('Hello world\n')
+
+        self.patches = [
+            patch.object(storage, 'FILE_ROOT', self.root),
+            patch.object(storage, 'BASE_PATH', self.base_path),
+            patch.object(storage, 'INDEX', Index()),
+            patch.object(storage, 'MEMORY', None),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+        shutil.rmtree(self.base_path, ignore_errors=True)
+
+    def test_resolve_path(self):
+        "Ensure the server and pregenerate name a file the same way."
+        for path in ('a/b.txt', './a/b.txt', 'a//b.txt', 'a/c/../b.txt'):
+            self.assertEqual(
+                resolve_path(path),
+                (pathjoin(self.root, 'a/b.txt'), 'a/b.txt'), path)
+
+    def test_iter_paths(self):
+        with NamedTemporaryFile('w', suffix='.txt') as t:
+            t.write('e.txt\n\n./missing.txt\n')
+            t.flush()
+            origins = [origin for _, origin in iter_paths(['a'], t.name)]
+
+        self.assertEqual(origins, ['a/b.txt', 'a/c/d.txt', 'e.txt'])
+
+    @patch('preview.MAX_PAGES', 0)
+    @patch('preview.MAX_SPRITE_PAGES', 50)
+    def test_sprite_pages(self):
+        self.assertEqual(preview_spec('sprite:160x120:1-5000')[3], (1, 50))
+        self.assertEqual(preview_spec('image:160x120:1-5000')[3], (1, 5000))
+
+    def test_skip_current(self):
+        "Ensure previews which are stored and current are skipped."
+        previews = [('image', 320, 240, (1, 1))]
+        loop = asyncio.get_event_loop()
+
+        stats = loop.run_until_complete(pregenerate(['e.txt'], previews, 1))
+        self.assertEqual((stats.generated, stats.skipped), (1, 0))
+
+        stats = loop.run_until_complete(pregenerate(['./e.txt'], previews, 1))
+        self.assertEqual((stats.generated, stats.skipped), (0, 1))
+
+        # Once the file changes, its preview is generated again.
+        st = os.stat(pathjoin(self.root, 'e.txt'))
+        os.utime(pathjoin(self.root, 'e.txt'),
+                 (st.st_atime, st.st_mtime + 10))
+        stats = loop.run_until_complete(pregenerate(['e.txt'], previews, 1))
+        self.assertEqual((stats.generated, stats.skipped), (1, 0))
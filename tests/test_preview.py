@@ -4,19 +4,24 @@ from unittest import TestCase
 
 from os.path import join as pathjoin, dirname
 
+from unittest.mock import patch
+
 from aiohttp.test_utils import unittest_run_loop
-from aiohttp import web
+from aiohttp import web, FormData
 
 from tests.base import PreviewTestCase
 
-from preview import parse_pages
-from preview.config import MAX_PAGES
+from preview import parse_pages, limit_sprite_pages
+from preview.preview import _store_info
+from preview.config import MAX_PAGES, MAX_SPRITE_PAGES
 
 
 ROOT = dirname(dirname(__file__))
 FIXTURE_SAMPLE_PDF = pathjoin(ROOT, 'fixtures/sample.pdf')
 FIXTURE_SAMPLE_DOC = pathjoin(ROOT, 'fixtures/sample.doc')
 FIXTURE_QUICKTIME_MOV = pathjoin(ROOT, 'fixtures/Quicktime_Video.mov')
+FIXTURE_DEBUG_LOG = pathjoin(ROOT, 'fixtures/debug.log')
+FIXTURE_W64_EXE = pathjoin(ROOT, 'fixtures/w64.exe')
 
 
 class PreviewFormatTestCase(PreviewTestCase):
@@ -40,6 +45,30 @@ class PreviewFormatTestCase(PreviewTestCase):
         self.assertEqual(r.status, 200)
         self.assertEqual(r.headers['content-type'], 'image/gif')
 
+    @unittest_run_loop
+    async def test_text(self):
+        "Request a preview of a text file and ensure GIF is returned."
+        r = await self.client.request(
+            'GET', '/preview/', params={
+                'format': 'image',
+                'path': FIXTURE_DEBUG_LOG})
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.headers['content-type'], 'image/gif')
+
+    @unittest_run_loop
+    async def test_sprite(self):
+        "Request a sprite of two pages, ensure PNG and a map are returned."
+        r = await self.client.request(
+            'GET', '/preview/', params={
+                'format': 'sprite',
+                'pages': '1-2',
+                'width': '320',
+                'height': '240',
+                'path': FIXTURE_SAMPLE_PDF})
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.headers['content-type'], 'image/png')
+        self.assertEqual(r.headers['x-sprite-map'], '1=0,2=240')
+
     @unittest_run_loop
     async def test_invalid(self):
         'Request an invalid format and ensure a 400 is returned.'
@@ -59,6 +88,16 @@ class PreviewFormatTestCase(PreviewTestCase):
                 'pages': '10'})
         self.assertEqual(r.status, 400)
 
+    @unittest_run_loop
+    async def test_text_page_oob(self):
+        'Request an invalid page from a text file.'
+        r = await self.client.request(
+            'GET', '/preview/', params={
+                'format': 'image',
+                'path': FIXTURE_DEBUG_LOG,
+                'pages': '10'})
+        self.assertEqual(r.status, 400)
+
     @unittest_run_loop
     async def test_doc_page_oob(self):
         'Request an invalid page from a pdf.'
@@ -70,6 +109,114 @@ class PreviewFormatTestCase(PreviewTestCase):
         self.assertEqual(r.status, 400)
 
 
+class InfoTestCase(PreviewTestCase):
+    @unittest_run_loop
+    async def test_pdf(self):
+        "Request info for a pdf and ensure each page has a size."
+        r = await self.client.request(
+            'GET', '/info/', params={'path': FIXTURE_SAMPLE_PDF})
+        self.assertEqual(r.status, 200)
+        info = await r.json()
+        self.assertEqual(info['type'], 'pdf')
+        self.assertEqual(info['units'], 'pt')
+        self.assertGreater(info['pages'], 1)
+        self.assertEqual(len(info['sizes']), info['pages'])
+
+    @unittest_run_loop
+    async def test_text(self):
+        "Request info for a text file."
+        r = await self.client.request(
+            'GET', '/info/', params={'path': FIXTURE_DEBUG_LOG})
+        self.assertEqual(r.status, 200)
+        info = await r.json()
+        self.assertEqual(info['type'], 'text')
+        self.assertEqual(len(info['sizes']), info['pages'])
+
+    @unittest_run_loop
+    async def test_postscript(self):
+        "Ensure the pages of PostScript are reported as unknown."
+        data = FormData()
+        data.add_field('file', b'%!PS\nshowpage\nshowpage\n',
+                       filename='pages.ps')
+        r = await self.client.request('POST', '/info/', data=data)
+        self.assertEqual(r.status, 200)
+        info = await r.json()
+        self.assertEqual(info['type'], 'pdf')
+        self.assertIsNone(info['pages'])
+
+    @unittest_run_loop
+    async def test_invalid(self):
+        "Request info without a file and ensure a 400 is returned."
+        r = await self.client.request('GET', '/info/')
+        self.assertEqual(r.status, 400)
+
+
+@patch('preview.storage.FILE_ROOT', ROOT)
+@patch('preview.models.FILE_ROOT', ROOT)
+class ConditionalTestCase(PreviewTestCase):
+    async def _get(self, path=FIXTURE_DEBUG_LOG, headers=None):
+        # Paths are given relative to PVS_FILES.
+        return await self.client.request(
+            'GET', '/preview/', headers=headers,
+            params={'path': os.path.relpath(path, ROOT)})
+
+    @unittest_run_loop
+    async def test_if_none_match(self):
+        "Ensure a matching ETag returns 304, and another the preview."
+        r = await self._get()
+        self.assertEqual(r.status, 200)
+        etag = r.headers['ETag']
+
+        r = await self._get(headers={'If-None-Match': etag})
+        self.assertEqual(r.status, 304)
+        self.assertEqual(r.headers['ETag'], etag)
+
+        r = await self._get(headers={'If-None-Match': 'W/%s' % etag})
+        self.assertEqual(r.status, 304)
+
+        r = await self._get(headers={'If-None-Match': '"other"'})
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.headers['ETag'], etag)
+
+    @unittest_run_loop
+    async def test_if_modified_since(self):
+        "Ensure an unmodified shared file returns 304."
+        r = await self._get()
+        self.assertEqual(r.status, 200)
+        last_modified = r.headers['Last-Modified']
+
+        r = await self._get(headers={'If-Modified-Since': last_modified})
+        self.assertEqual(r.status, 304)
+
+        r = await self._get(headers={
+            'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(r.status, 200)
+
+    @unittest_run_loop
+    async def test_icon(self):
+        "Ensure an icon served in place of a preview has no validators."
+        r = await self._get(path=FIXTURE_W64_EXE)
+        self.assertEqual(r.status, 200)
+        self.assertNotIn('ETag', r.headers)
+        self.assertNotIn('Last-Modified', r.headers)
+
+
+class StoreInfoTestCase(TestCase):
+    def test_store_full(self):
+        "Ensure the temporary file is removed if it could not be stored."
+        paths = []
+
+        def put_intermediate(key, obj, path, cost=None):
+            paths.append(path)
+            return path
+
+        with patch('preview.storage.put_intermediate', put_intermediate):
+            _store_info('key', None, {'pages': 1}, 0)
+
+        self.assertEqual(len(paths), 1)
+        self.assertFalse(os.path.exists(paths[0]))
+
+
 class ParsePagesTestCase(TestCase):
     def test_parse_invalid(self):
         # Ensure that empty or missing values return the default.
@@ -88,3 +235,12 @@ class ParsePagesTestCase(TestCase):
         self.assertEqual(parse_pages('1-5'), (1, 5))
         # Ensure special argument "all" does the right thing.
         self.assertEqual(parse_pages('all'), (1, MAX_PAGES))
+
+    def test_limit_sprite(self):
+        self.assertEqual(limit_sprite_pages((1, 5)), (1, 5))
+        # Ensure MAX_SPRITE_PAGES is enforced, including for whole documents.
+        self.assertEqual(
+            limit_sprite_pages((3, 3 + MAX_SPRITE_PAGES)),
+            (3, 2 + MAX_SPRITE_PAGES))
+        self.assertEqual(
+            limit_sprite_pages((0, 0)), (1, MAX_SPRITE_PAGES))
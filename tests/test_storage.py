@@ -0,0 +1,205 @@
+import os
+import shutil
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import patch
+from tempfile import mkdtemp
+
+from os.path import isfile, dirname, join as pathjoin
+
+from PIL import Image
+
+from aiohttp import FormData
+from aiohttp.test_utils import unittest_run_loop
+
+from tests.base import PreviewTestCase
+
+from preview import storage, preview
+from preview.index import Index
+from preview.models import PathModel, BufferModel, PreviewModel
+from preview.storage import MemoryStore
+
+
+ROOT = dirname(dirname(__file__))
+FIXTURE_BG_PNG = pathjoin(ROOT, 'fixtures/bg.png')
+
+
+class MemoryStoreTestCase(TestCase):
+    def test_budget(self):
+        store = MemoryStore(10)
+        store.put('a', b'aaaa', 1)
+        store.put('b', b'bbbbbb', 1)
+        # Exactly at the budget, nothing is evicted.
+        self.assertEqual((len(store), store.size), (2, 10))
+        self.assertEqual(store.get('a'), (b'aaaa', 1))
+
+        # One byte over evicts the least recently used item, b.
+        store.put('c', b'c', 1)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual((len(store), store.size), (2, 5))
+
+    def test_replace(self):
+        store = MemoryStore(10)
+        store.put('a', b'aaaa', 1)
+        store.put('a', b'aa', 2)
+        self.assertEqual(store.get('a'), (b'aa', 2))
+        self.assertEqual((len(store), store.size), (1, 2))
+
+    def test_max_item(self):
+        store = MemoryStore(10, max_item=4)
+        store.put('a', b'aaaa', 1)
+        # Larger items are not kept, and do not evict others.
+        store.put('b', b'bbbbb', 1)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a'), (b'aaaa', 1))
+        self.assertEqual(store.size, 4)
+
+    def test_discard(self):
+        store = MemoryStore(10)
+        store.put('a', b'aaaa', 1)
+        store.discard('a')
+        store.discard('missing')
+        self.assertIsNone(store.get('a'))
+        self.assertEqual((len(store), store.size), (0, 0))
+
+
+class StaleTestCase(TestCase):
+    def setUp(self):
+        self.base_path = mkdtemp()
+        self.src = pathjoin(self.base_path, 'source.txt')
+        with open(self.src, 'w') as f:
+            f.write('source')
+        os.utime(self.src, (200, 200))
+
+        self.patches = [
+            patch.object(storage, 'BASE_PATH', self.base_path),
+            patch.object(storage, 'INDEX', Index()),
+            patch.object(storage, 'MEMORY', MemoryStore(100)),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.base_path, ignore_errors=True)
+
+    def make_obj(self):
+        class Obj(object):
+            src = PathModel(self.src)
+            origin = 'source.txt'
+            digest = None
+            dst = None
+
+        return Obj()
+
+    def test_memory(self):
+        obj = self.make_obj()
+        storage.MEMORY.put('key', b'preview', 200)
+        self.assertEqual(storage.get(obj, 'key'), (True, 'key'))
+        self.assertIsInstance(obj.dst, BufferModel)
+
+        # The source changed, the copy in memory is discarded.
+        os.utime(self.src, (300, 300))
+        self.assertEqual(storage.get(obj, 'key'), (False, 'key'))
+        self.assertIsNone(storage.MEMORY.get('key'))
+
+    def test_disk(self):
+        obj = self.make_obj()
+        path = storage.make_path('key')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'preview')
+        os.utime(path, (100, 100))
+        storage.INDEX.add('key', 7)
+
+        # The source is newer, the stored preview is removed.
+        self.assertEqual(storage.get(obj, 'key'), (False, 'key'))
+        self.assertFalse(isfile(path))
+        self.assertEqual(len(storage.INDEX), 0)
+
+
+class DeriveTestCase(TestCase):
+    def setUp(self):
+        self.base_path = mkdtemp()
+        self.patches = [
+            patch.object(storage, 'BASE_PATH', self.base_path),
+            patch.object(storage, 'INDEX', Index()),
+            patch.object(storage, 'MEMORY', None),
+            patch.object(storage, 'STORE_DERIVE', True),
+            patch.object(preview, 'STORE_DERIVE', True),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.base_path, ignore_errors=True)
+
+    def generate(self, width, height):
+        obj = PreviewModel(FIXTURE_BG_PNG, width, height, 'image',
+                           origin='bg.png', args={'pages': (1, 1)})
+        asyncio.get_event_loop().run_until_complete(preview.generate(obj))
+        return obj
+
+    def test_derive(self):
+        "Ensure a smaller preview is resized from a stored larger one."
+        self.generate(800, 600)
+
+        async def preview_async(obj):
+            self.fail('The preview was not derived')
+
+        with patch.object(preview.Backend, 'preview_async', preview_async):
+            obj = self.generate(320, 240)
+
+        with Image.open(obj.dst.path) as image:
+            self.assertEqual(image.size, (320, 240))
+        # Both sizes are stored.
+        self.assertEqual(len(storage.INDEX), 2)
+
+
+class ContentKeyTestCase(PreviewTestCase):
+    def setUp(self):
+        self.base_path = mkdtemp()
+        self.patches = [
+            patch.object(storage, 'BASE_PATH', self.base_path),
+            patch.object(storage, 'INDEX', Index()),
+            patch.object(storage, 'MEMORY', None),
+            patch.object(storage, 'STORE_CONTENT_KEYS', True),
+        ]
+        for p in self.patches:
+            p.start()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.base_path, ignore_errors=True)
+
+    async def upload(self, filename):
+        data = FormData()
+        with open(FIXTURE_BG_PNG, 'rb') as f:
+            data.add_field('file', f.read(), filename=filename)
+        return await self.client.request('POST', '/preview/', data=data)
+
+    @unittest_run_loop
+    async def test_upload(self):
+        "Ensure uploads of the same content share a stored preview."
+        r = await self.upload('first.png')
+        self.assertEqual(r.status, 200)
+        await r.read()
+        self.assertEqual(len(storage.INDEX), 1)
+
+        async def preview_async(obj):
+            self.fail('The preview was generated again')
+
+        with patch.object(preview.Backend, 'preview_async', preview_async):
+            r2 = await self.upload('second.png')
+            self.assertEqual(r2.status, 200)
+            await r2.read()
+
+        self.assertEqual(len(storage.INDEX), 1)
+        self.assertEqual(r.headers['ETag'], r2.headers['ETag'])
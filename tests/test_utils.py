@@ -0,0 +1,119 @@
+import time
+import asyncio
+
+from unittest import TestCase
+
+from preview.utils import SingleFlight, Latencies, CircuitBreaker
+
+
+class SingleFlightTestCase(TestCase):
+    def test_coalesce(self):
+        calls = []
+
+        async def work(i):
+            calls.append(i)
+            await asyncio.sleep(0.1)
+            return i
+
+        async def run():
+            flight = SingleFlight()
+            return await asyncio.gather(*[
+                flight('key', work, i) for i in range(5)])
+
+        results = asyncio.get_event_loop().run_until_complete(run())
+        # Only the first call should have been executed.
+        self.assertEqual(calls, [0])
+        self.assertEqual(results[0], (0, False))
+        self.assertEqual(results[1:], [(0, True)] * 4)
+
+    def test_exception(self):
+        async def fail():
+            raise ValueError('Failed')
+
+        async def run():
+            flight = SingleFlight()
+            return await asyncio.gather(*[
+                flight('key', fail) for i in range(3)],
+                return_exceptions=True)
+
+        results = asyncio.get_event_loop().run_until_complete(run())
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+
+
+class LatenciesTestCase(TestCase):
+    def test_percentile(self):
+        latencies = Latencies(size=100)
+        self.assertIsNone(latencies.percentile(95))
+        for i in range(200):
+            latencies.add(i)
+        # Only the most recent samples are kept.
+        self.assertEqual(len(latencies), 100)
+        self.assertEqual(latencies.percentile(0), 100)
+        self.assertEqual(latencies.percentile(50), 150)
+        self.assertEqual(latencies.percentile(95), 195)
+        self.assertEqual(latencies.percentile(100), 199)
+
+
+class CircuitBreakerTestCase(TestCase):
+    def test_open(self):
+        breaker = CircuitBreaker(0.5, 60, size=4)
+        for success in (True, False, True):
+            token = breaker.allow()
+            self.assertEqual(token, CircuitBreaker.NORMAL)
+            breaker.record(token, success)
+        self.assertFalse(breaker.is_open)
+
+        breaker.record(CircuitBreaker.NORMAL, False)
+        self.assertTrue(breaker.is_open)
+        self.assertIsNone(breaker.allow())
+
+    def test_trial(self):
+        breaker = CircuitBreaker(0.5, 0.1, size=2)
+        breaker.record(breaker.allow(), False)
+        breaker.record(breaker.allow(), False)
+        self.assertIsNone(breaker.allow())
+
+        time.sleep(0.1)
+        # A single trial call is allowed after cooldown.
+        token = breaker.allow()
+        self.assertEqual(token, CircuitBreaker.TRIAL)
+        self.assertIsNone(breaker.allow())
+        breaker.record(token, False)
+        self.assertTrue(breaker.is_open)
+
+        time.sleep(0.1)
+        token = breaker.allow()
+        self.assertEqual(token, CircuitBreaker.TRIAL)
+        breaker.record(token, True)
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.allow(), CircuitBreaker.NORMAL)
+
+    def test_late_success(self):
+        "Ensure a call allowed before the breaker opened does not close it."
+        breaker = CircuitBreaker(0.5, 60, size=2)
+        late = breaker.allow()
+        breaker.record(breaker.allow(), False)
+        breaker.record(breaker.allow(), False)
+        self.assertTrue(breaker.is_open)
+
+        breaker.record(late, True)
+        self.assertTrue(breaker.is_open)
+        self.assertIsNone(breaker.allow())
+
+    def test_late_failure(self):
+        "Ensure a call allowed before the breaker opened is not the trial."
+        breaker = CircuitBreaker(0.5, 0.1, size=2)
+        late = breaker.allow()
+        breaker.record(breaker.allow(), False)
+        breaker.record(breaker.allow(), False)
+
+        time.sleep(0.1)
+        trial = breaker.allow()
+        self.assertEqual(trial, CircuitBreaker.TRIAL)
+        # The late failure neither reopens the breaker nor ends the trial.
+        breaker.record(late, False)
+        self.assertIsNone(breaker.allow())
+
+        breaker.record(trial, True)
+        self.assertFalse(breaker.is_open)
@@ -0,0 +1,130 @@
+import os
+import shutil
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import patch
+from tempfile import mkdtemp
+
+from os.path import isfile
+
+from preview import storage, watcher
+from preview.index import Index
+from preview.storage import MemoryStore
+from preview.watcher import Watcher
+
+
+async def _watch(self):
+    "Stands in for Watcher.watch, so that inotifywait is not run."
+
+
+class WatcherTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.base_path = mkdtemp()
+        self.generated = []
+
+        async def generate(obj):
+            self.generated.append(
+                (obj.src.path, obj.origin, obj.format, obj.width, obj.height,
+                 obj.args['pages']))
+
+        self.patches = [
+            patch.object(storage, 'BASE_PATH', self.base_path),
+            patch.object(storage, 'INDEX', Index()),
+            patch.object(storage, 'MEMORY', MemoryStore(100)),
+            patch.object(watcher, 'generate', generate),
+            patch.object(Watcher, 'watch', _watch),
+        ]
+        for p in self.patches:
+            p.start()
+
+        for key, source, format in (
+                ('a', '/files/a.doc', 'image'),
+                ('a-pdf', '/files/a.doc', None),
+                ('b', '/files/dir/b.doc', 'image'),
+                ('c', '/files/c.doc', 'image')):
+            self.store(key, source, format)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.base_path, ignore_errors=True)
+
+    def store(self, key, source, format):
+        path = storage.make_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'preview')
+        storage.INDEX.add(key, 7, source=source, origin=source[7:],
+                          format=format, width=320, height=240,
+                          pages=(1, 1))
+        storage.MEMORY.put(key, b'preview', 0)
+
+    def assertStored(self, *keys):
+        self.assertEqual(
+            sorted(key for key, *_ in storage.INDEX.sources('/files')),
+            sorted(keys))
+        for key in 'a', 'a-pdf', 'b', 'c':
+            self.assertEqual(isfile(storage.make_path(key)), key in keys, key)
+            self.assertEqual(
+                storage.MEMORY.get(key) is not None, key in keys, key)
+
+    def wait(self, delay=0.3):
+        self.loop.run_until_complete(asyncio.sleep(delay))
+
+    def test_batching(self):
+        "Ensure changes are batched, and processed once after the delay."
+        w = Watcher(self.loop, root='/files', regenerate=0, delay=0.1)
+        calls = []
+
+        async def process():
+            calls.append(dict(w.pending))
+            w.pending = {}
+
+        with patch.object(w, 'process', process):
+            w.handle(b'CLOSE_WRITE,CLOSE /files/a.doc\n')
+            w.handle(b'CLOSE_WRITE,CLOSE /files/a.doc\n')
+            w.handle(b'MOVED_FROM /files/c.doc\n')
+            self.assertEqual(calls, [])
+            self.wait()
+
+            # A later change starts another batch.
+            w.handle(b'DELETE /files/a.doc\n')
+            self.wait()
+
+        self.assertEqual(calls, [
+            {'/files/a.doc': False, '/files/c.doc': True},
+            {'/files/a.doc': True},
+        ])
+
+    def test_overflow(self):
+        "Ensure lost events start a new session rather than a change."
+        w = Watcher(self.loop, root='/files', regenerate=0, delay=0.1)
+        with patch.object(storage, 'WATCH_SESSION', 1):
+            w.handle(b'Q_OVERFLOW \n')
+            self.assertNotEqual(storage.WATCH_SESSION, 1)
+        self.assertEqual(w.pending, {})
+
+    def test_invalidate(self):
+        "Ensure previews of changed files, and beneath directories, go."
+        w = Watcher(self.loop, root='/files', regenerate=0, delay=0.1)
+        w.handle(b'CLOSE_WRITE,CLOSE /files/a.doc\n')
+        w.handle(b'DELETE,ISDIR /files/dir\n')
+        w.handle(b'CLOSE_WRITE,CLOSE /files/other.doc\n')
+        self.wait()
+
+        self.assertStored('c')
+        self.assertEqual(self.generated, [])
+
+    def test_regenerate(self):
+        "Ensure changed, not removed, previews are regenerated."
+        w = Watcher(self.loop, root='/files', regenerate=1, delay=0.1)
+        w.handle(b'CLOSE_WRITE,CLOSE /files/a.doc\n')
+        w.handle(b'MOVED_FROM /files/c.doc\n')
+        self.wait()
+
+        self.assertStored('b')
+        # Intermediate files (without a format) are not regenerated.
+        self.assertEqual(self.generated, [
+            ('/files/a.doc', 'a.doc', 'image', 320, 240, (1, 1))])